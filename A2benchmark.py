@@ -0,0 +1,197 @@
+'''Time the training and inference code in notebookcode.py and write the results as JSON.
+
+    python A2benchmark.py [--quick] [--output A2benchmark-results.json] [--compare previous-results.json]
+
+Each result gives the best time of several repeats, samples per second, epochs per second where
+training is involved, and the peak resident set size of the process so far.  Peak RSS never decreases,
+so it is meaningful for a benchmark only when it is larger than for the benchmarks before it.
+'''
+
+import argparse
+import ast
+import contextlib
+import io
+import json
+import platform
+import resource
+import sys
+import time
+import types
+
+import numpy as np
+
+import A2data
+
+
+# Load only the function and class definitions and imports from notebookcode.py, as A2grader does.
+with open('notebookcode.py') as fp:
+    tree = ast.parse(fp.read(), 'eval')
+for node in tree.body[:]:
+    if (not isinstance(node, ast.FunctionDef) and
+        not isinstance(node, ast.Import) and
+        not isinstance(node, ast.ClassDef)):
+        tree.body.remove(node)
+module = types.ModuleType('notebookcodeStripped')
+code = compile(tree, 'notebookcodeStripped.py', 'exec')
+sys.modules['notebookcodeStripped'] = module
+exec(code, module.__dict__)
+from notebookcodeStripped import *
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+def best_time(f, repeats):
+    '''Smallest wall-clock seconds of repeats calls to f, with anything f prints discarded.'''
+    times = []
+    for repeat in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            f()
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def result(benchmark, params, seconds, n_samples, n_epochs=None):
+    row = {'benchmark': benchmark, 'params': params, 'seconds': seconds,
+           'samples_per_second': n_samples / seconds,
+           'epochs_per_second': n_epochs / seconds if n_epochs else None,
+           'peak_rss_mb': peak_rss_mb()}
+    epochs = f" {row['epochs_per_second']:10.1f} epochs/s" if n_epochs else ''
+    print(f"{benchmark:15s} {json.dumps(params):70s} {seconds:9.4f} s {row['samples_per_second']:12.0f} samples/s{epochs}")
+    return row
+
+
+def benchmark_adam(sizes, n_epochs, repeats):
+    '''Optimizers.adam on linear least squares problems of n_samples x n_inputs.'''
+    rows = []
+    for n_samples, n_inputs in sizes:
+        rng = np.random.default_rng(42)
+        X = rng.standard_normal((n_samples, n_inputs))
+        T = X @ rng.standard_normal((n_inputs, 1))
+
+        def train():
+            w = np.zeros(n_inputs)
+            error_f = lambda: np.mean((T[:, 0] - X @ w) ** 2)
+            gradient_f = lambda: -2 * X.T @ (T[:, 0] - X @ w) / n_samples
+            Optimizers(w).adam(error_f, gradient_f, n_epochs=n_epochs, learning_rate=0.01)
+
+        seconds = best_time(train, repeats)
+        rows.append(result('adam', {'n_samples': n_samples, 'n_inputs': n_inputs, 'n_epochs': n_epochs},
+                           seconds, n_samples * n_epochs, n_epochs))
+    return rows
+
+
+def benchmark_train(n_samples, n_inputs, widths, depths, activations, batch_sizes, n_epochs, repeats):
+    '''NeuralNetwork.train with adam over all combinations of hidden layer width, depth, activation and batch size.'''
+    rng = np.random.default_rng(42)
+    X = rng.standard_normal((n_samples, n_inputs))
+    T = np.sin(X.sum(axis=1, keepdims=True))
+    rows = []
+    for width in widths:
+        for depth in depths:
+            for activation in activations:
+                for batch_size in batch_sizes:
+                    def train():
+                        np.random.seed(42)
+                        NeuralNetwork(n_inputs, [width] * depth, 1, activation).train(
+                            X, T, n_epochs, 0.01, method='adam', batch_size=batch_size)
+                    seconds = best_time(train, repeats)
+                    params = {'n_samples': n_samples, 'width': width, 'depth': depth,
+                              'activation': activation, 'batch_size': batch_size, 'n_epochs': n_epochs}
+                    rows.append(result('train', params, seconds, n_samples * n_epochs, n_epochs))
+    return rows
+
+
+def benchmark_use(n_inputs, hiddens, batch_sizes, min_samples, repeats):
+    '''NeuralNetwork.use on batches of each size, called enough times to process at least min_samples samples.'''
+    rng = np.random.default_rng(42)
+    X = rng.standard_normal((max(batch_sizes), n_inputs))
+    T = np.sin(X.sum(axis=1, keepdims=True))
+    np.random.seed(42)
+    with contextlib.redirect_stdout(io.StringIO()):
+        nnet = NeuralNetwork(n_inputs, hiddens, 1).train(X[:1000], T[:1000], 10, 0.01, method='adam')
+    rows = []
+    for batch_size in batch_sizes:
+        Xbatch = X[:batch_size]
+        n_calls = max(1, min_samples // batch_size)
+
+        def use():
+            for call in range(n_calls):
+                nnet.use(Xbatch)
+
+        seconds = best_time(use, repeats)
+        params = {'hiddens': hiddens, 'batch_size': batch_size, 'n_calls': n_calls}
+        rows.append(result('use', params, seconds, batch_size * n_calls))
+    return rows
+
+
+def benchmark_run_experiment(n_epochs_choices, hiddens_choices, activations, repeats):
+    '''run_experiment on the auto-mpg data, with the same parameter values as the notebook.'''
+    data = A2data.load('auto-mpg.data-original')
+    X = data[:, 1:]
+    T = data[:, 0:1]
+
+    def sweep():
+        np.random.seed(42)
+        run_experiment(X, T, n_folds=5, n_epochs_choices=n_epochs_choices,
+                       n_hidden_units_per_layer_choices=hiddens_choices,
+                       activation_function_choices=activations)
+
+    seconds = best_time(sweep, repeats)
+    # Each configuration trains on 3 of the 5 folds for each number of epochs.
+    n_configs = len(hiddens_choices) * len(activations)
+    n_epochs = n_configs * sum(n_epochs_choices)
+    params = {'n_epochs_choices': n_epochs_choices, 'hiddens_choices': hiddens_choices, 'activations': activations}
+    return [result('run_experiment', params, seconds, X.shape[0] * 3 // 5 * n_epochs, n_epochs)]
+
+
+def compare(rows, filename):
+    '''Print the ratio of each time to the time of the same benchmark in an earlier results file.'''
+    with open(filename) as f:
+        previous = {(row['benchmark'], json.dumps(row['params'], sort_keys=True)): row['seconds']
+                    for row in json.load(f)['results']}
+    print(f'\nTime relative to {filename}')
+    for row in rows:
+        key = (row['benchmark'], json.dumps(row['params'], sort_keys=True))
+        if key in previous:
+            print(f"{row['benchmark']:15s} {json.dumps(row['params']):70s} {row['seconds'] / previous[key]:6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='smaller sizes and fewer repeats, for a quick check')
+    parser.add_argument('--output', default='A2benchmark-results.json')
+    parser.add_argument('--compare', help='earlier results file to compare times with')
+    args = parser.parse_args()
+
+    repeats = 1 if args.quick else 3
+    rows = []
+    if args.quick:
+        rows += benchmark_adam([(1000, 10), (10000, 100)], 100, repeats)
+        rows += benchmark_train(1000, 8, [10, 50], [1, 2], ['tanh', 'relu', 'swish'], [None, 100], 20, repeats)
+        rows += benchmark_use(8, [50, 50], [1, 10, 100, 1000, 10000], 10000, repeats)
+        rows += benchmark_run_experiment([100, 200], [[0], [10]], ['tanh'], repeats)
+    else:
+        rows += benchmark_adam([(1000, 10), (10000, 100), (100000, 100), (100000, 1000)], 200, repeats)
+        rows += benchmark_train(10000, 8, [10, 50, 200], [1, 2, 4], ['tanh', 'relu', 'swish', 'gelu'],
+                                [None, 32, 256], 20, repeats)
+        rows += benchmark_use(8, [50, 50], [1, 10, 100, 1000, 10000, 100000], 100000, repeats)
+        rows += benchmark_run_experiment([1000, 2000], [[0], [10], [100, 10]], ['tanh', 'relu'], repeats)
+
+    environment = {'python': platform.python_version(), 'numpy': np.__version__,
+                   'platform': platform.platform(), 'processor': platform.processor(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'quick': args.quick}
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment, 'results': rows}, f, indent=1)
+    print(f'\nWrote {len(rows)} results to {args.output}')
+
+    if args.compare:
+        compare(rows, args.compare)
+
+
+if __name__ == '__main__':
+    main()
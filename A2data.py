@@ -0,0 +1,118 @@
+'''Load whitespace-separated numeric data files, such as auto-mpg.data-original, into NumPy arrays.
+
+Each line holds numeric fields separated by spaces or tabs, optionally followed by a quoted string, such as
+the car name in auto-mpg.data-original, which is ignored.  Rows with a missing value, written as NA or ?,
+are dropped.
+
+    import A2data
+    data = A2data.load('auto-mpg.data-original')   # 392 x 8 float64 array, cached in auto-mpg.data-original.float64.npy
+    for chunk in A2data.read_chunks('big.data', chunk_rows=1000000):
+        ...
+'''
+
+import io
+import itertools
+import os
+import re
+
+import numpy as np
+
+
+# Missing values other than nan and NaN, which np.loadtxt reads as nan itself.
+missing_values = ['NA', '?']
+
+# A missing value as a whole field, so that NAN, a spelling of nan, is not changed to nanN.
+missing_value_pattern = re.compile(r'(?<!\S)(?:' + '|'.join(map(re.escape, missing_values)) + r')(?!\S)')
+
+
+def numeric_fields(line):
+    '''Fields of line before any quoted string.'''
+    return line.partition('"')[0].split()
+
+
+def count_columns(filename):
+    '''Return the number of numeric fields in the first line that is not blank, or None if there is none.'''
+    with open(filename) as f:
+        for line in f:
+            fields = numeric_fields(line)
+            if fields:
+                return len(fields)
+    return None
+
+
+def read_chunks(filename, chunk_rows=100000, dtype=np.float64):
+    '''Generator of n_rows x n_columns arrays of the rows without missing values in each chunk_rows lines of
+filename.  n_columns is the number of numeric fields in the first line, and a line with a different number
+raises a ValueError.  Blank lines are skipped.'''
+    n_columns = None
+    first_line = 1
+    with open(filename) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                break
+            where = f'{filename}, lines {first_line}-{first_line + len(lines) - 1}'
+            first_line += len(lines)
+            # Parse the numeric fields of all lines at once with np.loadtxt, with each missing value as nan.
+            text = '\n'.join([line.partition('"')[0] for line in lines])
+            if any(missing in text for missing in missing_values):
+                text = missing_value_pattern.sub('nan', text)
+            if text.isspace():
+                continue
+            try:
+                rows = np.loadtxt(io.StringIO(text), dtype=dtype, comments=None, ndmin=2)
+            except ValueError as ex:
+                raise ValueError(f'{where}: {ex}') from ex
+            if n_columns is None:
+                n_columns = rows.shape[1]
+            elif rows.shape[1] != n_columns:
+                raise ValueError(f'{where}: {rows.shape[1]} numeric fields, expected {n_columns}')
+            rows = rows[~np.isnan(rows).any(axis=1)]
+            if rows.shape[0] > 0:
+                yield rows
+
+
+def save_npy(filename, npy_filename, dtype=np.float64, chunk_rows=100000):
+    '''Write the rows of filename without missing values to npy_filename, appending one chunk at a time, so
+files larger than memory can be converted in one pass.  npy_filename is replaced only once it is complete.'''
+    dtype = np.dtype(dtype)
+    n_columns = count_columns(filename)
+    if n_columns is None:
+        raise ValueError(f'{filename} has no numeric fields')
+    header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (0, n_columns)}
+    temporary_filename = npy_filename + '.tmp'
+    with open(temporary_filename, 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, header)
+        header_length = f.tell()
+        n_rows = 0
+        for chunk in read_chunks(filename, chunk_rows, dtype):
+            f.write(chunk.tobytes())
+            n_rows += chunk.shape[0]
+        # NumPy pads the header with room for the number of rows to grow, so it can be rewritten in place.
+        f.seek(0)
+        header['shape'] = (n_rows, n_columns)
+        np.lib.format.write_array_header_1_0(f, header)
+        if f.tell() != header_length:
+            raise ValueError(f'.npy header for {n_rows} rows does not fit in the space written for it')
+    os.replace(temporary_filename, npy_filename)
+
+
+def load(filename, dtype=np.float64, cache=True, mmap_mode=None, chunk_rows=100000):
+    '''Return a contiguous n_rows x n_columns array of the rows of filename without missing values.
+cache: if True, the array is saved in filename.<dtype>.npy, such as auto-mpg.data-original.float64.npy,
+       and later calls load that file instead of parsing filename again, unless filename has changed since.
+mmap_mode: if cache is True, mode for np.load of the .npy file, such as 'r' to memory-map it
+           rather than read it into memory'''
+    dtype = np.dtype(dtype)
+    if not cache:
+        chunks = list(read_chunks(filename, chunk_rows, dtype))
+        if not chunks:
+            n_columns = count_columns(filename)
+            if n_columns is None:
+                raise ValueError(f'{filename} has no numeric fields')
+            return np.empty((0, n_columns), dtype=dtype)
+        return np.concatenate(chunks)
+    npy_filename = f'{filename}.{dtype.name}.npy'
+    if not os.path.exists(npy_filename) or os.path.getmtime(npy_filename) < os.path.getmtime(filename):
+        save_npy(filename, npy_filename, dtype, chunk_rows)
+    return np.load(npy_filename, mmap_mode=mmap_mode)
@@ -33,98 +33,377 @@ import matplotlib.pyplot as plt
 
 class Optimizers():
 
-    def __init__(self, all_weights):
-        '''all_weights is a vector of all of a neural networks weights concatenated into a one-dimensional vector'''
+    # Names of the optimization methods that NeuralNetwork.train accepts, each mapped to the name of a method
+    # of Optimizers that takes the same arguments as sgd.  Other methods can be added with functions in place
+    # of the names, which are called with the Optimizers object as the first argument.
+    methods = {'sgd': 'sgd',
+               'momentum': 'momentum',
+               'nesterov': 'nesterov',
+               'rmsprop': 'rmsprop',
+               'adam': 'adam',
+               'adamw': 'adamw',
+               'lbfgs': 'lbfgs'}
+
+    # Names of learning rate schedules, each mapped to the name of a static method of Optimizers.  A schedule
+    # is called as f(epoch, n_epochs, learning_rate), with epoch counting from 0, and returns the learning rate
+    # for that epoch.  Functions can be used in place of the names.
+    schedules = {'constant': 'constant_schedule',
+                 'step': 'step_schedule',
+                 'cosine': 'cosine_schedule',
+                 'exponential': 'exponential_schedule',
+                 'one_cycle': 'one_cycle_schedule',
+                 'warmup': 'warmup_schedule'}
+
+    def __init__(self, all_weights, dtype=None):
+        '''all_weights is a vector of all of a neural networks weights concatenated into a one-dimensional vector
+dtype is the type of the optimizer's own arrays, such as adam's mt and vt.  Defaults to all_weights.dtype,
+but can be np.float64 to accumulate moments precisely for np.float32 weights.'''
         
         self.all_weights = all_weights
 
         # The following initializations are only used by adam.
         # Only initializing mt, vt, beta1t and beta2t here allows multiple calls to adam to handle training
         # with multiple subsets (batches) of training data.
-        self.mt = np.zeros_like(all_weights)
-        self.vt = np.zeros_like(all_weights)
+        self.mt = np.zeros_like(all_weights, dtype=dtype)
+        self.vt = np.zeros_like(all_weights, dtype=dtype)
         self.beta1 = 0.9
         self.beta2 = 0.999
         self.beta1t = 1  # was self.beta1
         self.beta2t = 1  # was self.beta2
+        self.buffer = np.empty_like(self.mt)  # for intermediate results of each step
+
+        # Settings of the other methods.  momentum and nesterov keep their velocity in mt, rmsprop its
+        # mean squared gradient in vt.
+        self.mu = 0.9              # momentum and nesterov: fraction of velocity kept each step
+        self.rho = 0.9             # rmsprop: fraction of mean squared gradient kept each step
+        self.weight_decay = 0.01   # adamw: fraction of each weight, times learning_rate, removed each step
+        self.history_size = 10     # lbfgs: number of steps remembered to approximate the inverse Hessian
+        self.schedule = None  # function from Optimizers.schedules, or None for a constant learning rate
+        self.start_epoch = 0  # epochs of the run already done, when resuming from a checkpoint file
+        self.profiler = None  # a Profiler to time the phases of each epoch
 
         
-    def sgd(self, error_f, gradient_f, fargs=[], n_epochs=100, learning_rate=0.001, error_convert_f=None):
+    def sgd(self, error_f, gradient_f, fargs=[], n_epochs=100, learning_rate=0.001, error_convert_f=None,
+            batches_f=None, epoch_callback_f=None, error_gradient_f=None):
         '''
 error_f: function that requires X and T as arguments (given in fargs) and returns mean squared error.
 gradient_f: function that requires X and T as arguments (in fargs) and returns gradient of mean squared error
             with respect to each weight.
 error_convert_f: function that converts the standardized error from error_f to original T units.
+batches_f: function that returns an iterable of fargs lists, one per batch of training data.  If given,
+           fargs is ignored and the weights are updated once per batch in each epoch.
+epoch_callback_f: function called as epoch_callback_f(epoch, error) at the end of each epoch, with epoch
+                  counting from 1 and error as appended to the returned error trace.  Training stops
+                  if it returns True.
+error_gradient_f: function that requires the same arguments as error_f and returns a tuple of what
+                  error_f and gradient_f would return, from one pass through the data.  If given, it
+                  is used instead of error_f and gradient_f.
         '''
 
-        error_trace = []
-        epochs_per_print = n_epochs // 10
-
-        for epoch in range(n_epochs):
+        return self.run_epochs(self.sgd_step, 'sgd', error_f, gradient_f, fargs, n_epochs, learning_rate,
+                               error_convert_f, batches_f, epoch_callback_f, error_gradient_f)
 
-            error = error_f(*fargs)
-            grad = gradient_f(*fargs)
-
-            # Update all weights using -= to modify their values in-place.
-            self.all_weights -= learning_rate * grad
-
-            if error_convert_f:
-                error = error_convert_f(error)
-            error_trace.append(error)
-
-            if (epoch + 1) % max(1, epochs_per_print) == 0:
-                print(f'sgd: Epoch {epoch+1:d} Error={error:.5f}')
-
-        return error_trace
+    def sgd_step(self, grad, learning_rate):
+        # Update all weights using -= to modify their values in-place.
+        self.all_weights -= learning_rate * grad
 
-    def adam(self, error_f, gradient_f, fargs=[], n_epochs=100, learning_rate=0.001, error_convert_f=None):
+    def adam(self, error_f, gradient_f, fargs=[], n_epochs=100, learning_rate=0.001, error_convert_f=None,
+             batches_f=None, epoch_callback_f=None, error_gradient_f=None):
         '''
 error_f: function that requires X and T as arguments (given in fargs) and returns mean squared error.
 gradient_f: function that requires X and T as arguments (in fargs) and returns gradient of mean squared error
             with respect to each weight.
 error_convert_f: function that converts the standardized error from error_f to original T units.
+batches_f: function that returns an iterable of fargs lists, one per batch of training data.  If given,
+           fargs is ignored and the weights are updated once per batch in each epoch.  mt, vt, beta1t
+           and beta2t carry over from one batch to the next.
+epoch_callback_f: function called as epoch_callback_f(epoch, error) at the end of each epoch, with epoch
+                  counting from 1 and error as appended to the returned error trace.  Training stops
+                  if it returns True.
+error_gradient_f: function that requires the same arguments as error_f and returns a tuple of what
+                  error_f and gradient_f would return, from one pass through the data.  If given, it
+                  is used instead of error_f and gradient_f.
         '''
 
+        return self.run_epochs(self.adam_step, 'Adam', error_f, gradient_f, fargs, n_epochs, learning_rate,
+                               error_convert_f, batches_f, epoch_callback_f, error_gradient_f)
+
+    def adam_step(self, grad, learning_rate):
+        '''Updates mt, vt and all_weights in place, with self.buffer for intermediate results.'''
         alpha = learning_rate  # learning rate called alpha in original paper on adam
         epsilon = 1e-8
+        buffer = self.buffer
+
+        #approximate first and second moment
+        self.mt *= self.beta1
+        self.mt += np.multiply(grad, 1 - self.beta1, out=buffer)
+        self.vt *= self.beta2
+        self.vt += np.multiply(np.square(grad, out=buffer), 1 - self.beta2, out=buffer)
+
+        #bias correction
+        self.beta1t *= self.beta1
+        self.beta2t *= self.beta2
+
+        # alpha * mhat / (sqrt(vhat) + epsilon), with mhat = mt / (1 - beta1t) and vhat = vt / (1 - beta2t),
+        # equals step * mt / (sqrt(vt) + epsilon_hat), so the bias corrections are applied to scalars.
+        step = alpha * np.sqrt(1 - self.beta2t) / (1 - self.beta1t)
+        epsilon_hat = epsilon * np.sqrt(1 - self.beta2t)
+        np.sqrt(self.vt, out=buffer)
+        buffer += epsilon_hat
+        np.divide(self.mt, buffer, out=buffer)
+        buffer *= step
+        self.all_weights -= buffer
+
+    def run_method(self, method, *args, **kwargs):
+        '''Call the optimization method named method in Optimizers.methods with the remaining arguments.'''
+        if method not in self.methods:
+            raise Exception(f'method must be one of {list(self.methods)}')
+        f = self.methods[method]
+        return getattr(self, f)(*args, **kwargs) if isinstance(f, str) else f(self, *args, **kwargs)
+
+    def momentum(self, error_f, gradient_f, fargs=[], n_epochs=100, learning_rate=0.001, error_convert_f=None,
+                 batches_f=None, epoch_callback_f=None, error_gradient_f=None):
+        '''sgd with a velocity that keeps fraction self.mu of the previous step.  Arguments are as for sgd.'''
+
+        return self.run_epochs(self.momentum_step, 'momentum', error_f, gradient_f, fargs, n_epochs,
+                               learning_rate, error_convert_f, batches_f, epoch_callback_f, error_gradient_f)
+
+    def momentum_step(self, grad, learning_rate):
+        self.mt *= self.mu
+        self.mt -= np.multiply(grad, learning_rate, out=self.buffer)
+        self.all_weights += self.mt
+
+    def nesterov(self, error_f, gradient_f, fargs=[], n_epochs=100, learning_rate=0.001, error_convert_f=None,
+                 batches_f=None, epoch_callback_f=None, error_gradient_f=None):
+        '''momentum with Nesterov's correction, which steps along the gradient plus the velocity it is about
+to have, rather than the velocity it has.  Arguments are as for sgd.'''
+
+        return self.run_epochs(self.nesterov_step, 'Nesterov', error_f, gradient_f, fargs, n_epochs,
+                               learning_rate, error_convert_f, batches_f, epoch_callback_f, error_gradient_f)
+
+    def nesterov_step(self, grad, learning_rate):
+        buffer = self.buffer
+        self.mt *= self.mu
+        self.mt += grad
+        np.multiply(self.mt, self.mu, out=buffer)
+        buffer += grad
+        buffer *= learning_rate
+        self.all_weights -= buffer
+
+    def rmsprop(self, error_f, gradient_f, fargs=[], n_epochs=100, learning_rate=0.001, error_convert_f=None,
+                batches_f=None, epoch_callback_f=None, error_gradient_f=None):
+        '''sgd with each weight's step divided by the root of a running mean of its squared gradient, which
+keeps fraction self.rho of the previous mean.  Arguments are as for sgd.'''
+
+        return self.run_epochs(self.rmsprop_step, 'RMSProp', error_f, gradient_f, fargs, n_epochs,
+                               learning_rate, error_convert_f, batches_f, epoch_callback_f, error_gradient_f)
+
+    def rmsprop_step(self, grad, learning_rate):
+        epsilon = 1e-8
+        buffer = self.buffer
+        self.vt *= self.rho
+        self.vt += np.multiply(np.square(grad, out=buffer), 1 - self.rho, out=buffer)
+        np.sqrt(self.vt, out=buffer)
+        buffer += epsilon
+        np.divide(grad, buffer, out=buffer)
+        buffer *= learning_rate
+        self.all_weights -= buffer
+
+    def adamw(self, error_f, gradient_f, fargs=[], n_epochs=100, learning_rate=0.001, error_convert_f=None,
+              batches_f=None, epoch_callback_f=None, error_gradient_f=None):
+        '''adam with weight decay applied directly to the weights rather than added to the gradient, so it is not
+scaled by adam's moments.  Each step removes learning_rate * self.weight_decay of every weight, including
+biases.  Arguments are as for sgd.'''
+
+        return self.run_epochs(self.adamw_step, 'AdamW', error_f, gradient_f, fargs, n_epochs,
+                               learning_rate, error_convert_f, batches_f, epoch_callback_f, error_gradient_f)
+
+    def adamw_step(self, grad, learning_rate):
+        self.all_weights -= np.multiply(self.all_weights, learning_rate * self.weight_decay, out=self.buffer)
+        self.adam_step(grad, learning_rate)
+
+    def lbfgs(self, error_f, gradient_f, fargs=[], n_epochs=100, learning_rate=0.001, error_convert_f=None,
+              batches_f=None, epoch_callback_f=None, error_gradient_f=None):
+        '''Limited-memory BFGS.  Each epoch steps along a direction from the gradient and the changes in weights
+and gradients of the last self.history_size epochs, with a backtracking line search for a length that
+decreases the error enough.  learning_rate is only the step size of the first epoch, before there are any
+changes to use.  Uses all samples in every epoch, so batches_f cannot be given.  Other arguments are as
+for sgd.'''
+
+        if batches_f:
+            raise Exception('lbfgs uses all samples in every epoch, so batches_f cannot be given')
+        if error_gradient_f is None:
+            error_gradient_f = lambda *fargs: (error_f(*fargs), gradient_f(*fargs))
+
+        self.lbfgs_history = []  # (s, y, 1 / y.s) of recent epochs, oldest first
+        self.lbfgs_previous = None  # error and gradient found by the line search, for the next epoch
+
+        def lbfgs_error_gradient_f(*fargs):
+            # The line search ends with the error and gradient at the new weights, so reuse them.
+            if self.lbfgs_previous is None:
+                error, grad = error_gradient_f(*fargs)
+                self.lbfgs_previous = (error, np.array(grad, dtype=np.float64))
+            return self.lbfgs_previous
+
+        step_f = lambda grad, learning_rate: self.lbfgs_step(grad, learning_rate, error_gradient_f, fargs)
+        return self.run_epochs(step_f, 'L-BFGS', None, None, fargs, n_epochs, learning_rate,
+                               error_convert_f, None, epoch_callback_f, lbfgs_error_gradient_f)
+
+    def lbfgs_step(self, grad, learning_rate, error_gradient_f, fargs):
+        '''grad is the float64 gradient at the current weights, with its error in self.lbfgs_previous.'''
+        error = self.lbfgs_previous[0]
+        history = self.lbfgs_history
+
+        # Two-loop recursion for the product of the approximate inverse Hessian and the gradient.
+        q = grad.copy()
+        alphas = []
+        for s, y, rho in reversed(history):
+            alpha = rho * (s @ q)
+            q -= alpha * y
+            alphas.append(alpha)
+        if history:
+            s, y, rho = history[-1]
+            q *= (s @ y) / (y @ y)
+        else:
+            q *= learning_rate
+        for (s, y, rho), alpha in zip(history, reversed(alphas)):
+            beta = rho * (y @ q)
+            q += (alpha - beta) * s
+        direction = -q
+        slope = grad @ direction
+        if slope >= 0:
+            # Not a descent direction, so forget the history and follow the gradient.
+            history.clear()
+            direction = -learning_rate * grad
+            slope = grad @ direction
+
+        # Backtracking line search for a step with sufficient decrease (Armijo condition).
+        weights = np.array(self.all_weights, dtype=np.float64)
+        step = 1.0
+        for i in range(30):
+            self.all_weights[:] = weights + step * direction
+            new_error, new_grad = error_gradient_f(*fargs)
+            if new_error <= error + 1e-4 * step * slope:
+                break
+            step *= 0.5
+        new_grad = np.array(new_grad, dtype=np.float64)
+        self.lbfgs_previous = (new_error, new_grad)
+
+        s = np.asarray(self.all_weights, dtype=np.float64) - weights
+        y = new_grad - grad
+        if y @ s > 1e-10:
+            history.append((s, y, 1 / (y @ s)))
+            if len(history) > self.history_size:
+                history.pop(0)
+
+    def run_epochs(self, step_f, name, error_f, gradient_f, fargs, n_epochs, learning_rate, error_convert_f,
+                   batches_f, epoch_callback_f, error_gradient_f):
+        '''Loop shared by all optimizers.  step_f(grad, learning_rate) updates self.all_weights in place.
+The error recorded for an epoch is the mean of the errors of its batches.'''
+
         error_trace = []
         epochs_per_print = n_epochs // 10
-
-        for epoch in range(n_epochs):
-
-            error = error_f(*fargs)
-            grad = gradient_f(*fargs)
-
-            # Finish Adam implementation here by updating
-            #   self.mt
-            #   self.vt
-            #   self.beta1t
-            #   self.beta2t
-            # and updating values of self.all_weights
-            
-            #approximate first and second moment
-            self.mt = (self.beta1 * self.mt) + (1 - self.beta1) * grad
-            self.vt = (self.beta2 * self.vt) + (1 - self.beta2) * np.square(grad)
-            
-            #bias correction
-            self.beta1t *= self.beta1
-            self.beta2t *= self.beta2
-            
-            mhat = self.mt / (1 - self.beta1t)
-            vhat = self.vt / (1 - self.beta2t)
-            
-            self.all_weights -= alpha * mhat / (np.sqrt(vhat) + epsilon)
-            
+        profiler = self.profiler
+        schedule = self.schedule
+        epoch_learning_rate = learning_rate
+
+        for epoch in range(self.start_epoch, n_epochs):
+
+            if schedule is not None:
+                epoch_learning_rate = schedule(epoch, n_epochs, learning_rate)
+
+            if profiler is not None:
+                epoch_token = profiler.start()
+
+            batch_errors = []
+            for batch_fargs in (batches_f() if batches_f else [fargs]):
+                if profiler is not None:
+                    token = profiler.start()
+                if error_gradient_f:
+                    error, grad = error_gradient_f(*batch_fargs)
+                else:
+                    error = error_f(*batch_fargs)
+                    grad = gradient_f(*batch_fargs)
+                if profiler is not None:
+                    profiler.stop('error and gradient', token)
+                    token = profiler.start()
+                step_f(grad, epoch_learning_rate)
+                if profiler is not None:
+                    profiler.stop(name + ' step', token)
+                batch_errors.append(error)
+
+            if len(batch_errors) == 0:
+                raise Exception('batches_f returned no batches.  For n_epochs > 1 it must return a new iterable each call.')
+            error = batch_errors[0] if len(batch_errors) == 1 else np.mean(batch_errors)
 
             if error_convert_f:
                 error = error_convert_f(error)
             error_trace.append(error)
 
-            if (epoch + 1) % max(1, epochs_per_print) == 0:
-                print(f'Adam: Epoch {epoch+1:d} Error={error:.5f}')
+            if profiler is not None:
+                token = profiler.start()
+            stop = epoch_callback_f(epoch + 1, error) if epoch_callback_f else False
+            if profiler is not None:
+                profiler.stop('epoch callback', token)
+                token = profiler.start()
+
+            if (epoch + 1) % max(1, epochs_per_print) == 0 or stop:
+                print(f'{name}: Epoch {epoch+1:d} Error={error:.5f}')
+
+            if profiler is not None:
+                profiler.stop('print', token)
+                profiler.stop('epoch', epoch_token)
+                profiler.end_epoch(epoch + 1, error)
+
+            if stop:
+                break
 
         return error_trace
 
+    @classmethod
+    def get_schedule(cls, schedule):
+        '''schedule is a name in Optimizers.schedules, a function, or None for a constant learning rate.'''
+        if schedule is None or callable(schedule):
+            return schedule
+        if schedule not in cls.schedules:
+            raise Exception(f'schedule must be one of {list(cls.schedules)}, a function or None')
+        return getattr(cls, cls.schedules[schedule])
+
+    @staticmethod
+    def constant_schedule(epoch, n_epochs, learning_rate):
+        return learning_rate
+
+    @staticmethod
+    def step_schedule(epoch, n_epochs, learning_rate):
+        '''Divided by 10 after half of the epochs, and by 10 again after three quarters.'''
+        return learning_rate * 0.1 ** ((epoch >= n_epochs / 2) + (epoch >= n_epochs * 3 / 4))
+
+    @staticmethod
+    def cosine_schedule(epoch, n_epochs, learning_rate):
+        '''Decreases along half a cosine wave from learning_rate towards 0.'''
+        return learning_rate * 0.5 * (1 + np.cos(np.pi * epoch / n_epochs))
+
+    @staticmethod
+    def exponential_schedule(epoch, n_epochs, learning_rate):
+        '''Decreases by a constant factor each epoch, to 1% of learning_rate at the end.'''
+        return learning_rate * 0.01 ** (epoch / n_epochs)
+
+    @staticmethod
+    def one_cycle_schedule(epoch, n_epochs, learning_rate):
+        '''Increases linearly from learning_rate / 25 to learning_rate over the first 30% of the epochs, then
+decreases along half a cosine wave towards learning_rate / 10000.'''
+        n_warmup = 0.3 * n_epochs
+        if epoch < n_warmup:
+            return learning_rate * (0.04 + 0.96 * epoch / n_warmup)
+        fraction = (epoch - n_warmup) / (n_epochs - n_warmup)
+        return learning_rate * (1e-4 + (1 - 1e-4) * 0.5 * (1 + np.cos(np.pi * fraction)))
+
+    @staticmethod
+    def warmup_schedule(epoch, n_epochs, learning_rate):
+        '''Increases linearly to learning_rate over the first 10% of the epochs, then stays constant.'''
+        n_warmup = max(1, n_epochs // 10)
+        return learning_rate * min(1, (epoch + 1) / n_warmup)
+
 
 # Test `Optimizers` using the function `test_optimizers`.  You should get the same results shown below.
 
@@ -622,10 +901,10 @@ get_ipython().system('curl -O https://archive.ics.uci.edu/ml/machine-learning-da
 
 
 import pandas as pd
-df  = pd.read_csv("auto-mpg.data-original", header=None, delim_whitespace=True, na_values='?')
-df = df.dropna()
-data = df.iloc[:, :-1].values
-df
+import A2data
+# Numeric columns of the rows without missing values, parsed once and then loaded from a .npy cache.
+data = A2data.load('auto-mpg.data-original')
+data.shape
 
 
 # In[14]:
@@ -637,32 +916,53 @@ np.random.seed(42)
 # In[15]:
 
 
-def partition(X, T, n_folds, random_shuffle=True):
-    rows = np.arange(X.shape[0])
-    if(random_shuffle == True):
+def partition_indices(n_samples, n_folds, random_shuffle=True):
+    '''Return a list of the rows in each of n_folds folds of n_samples samples.  If random_shuffle, rows are
+shuffled and each fold is a view of one array of row indices.  Otherwise each fold is a slice, so indexing
+an array with it gives a view rather than a copy.'''
+    n_per_fold = n_samples // n_folds # double-slash = "floor division" which rounds down to the nearest number
+    # The last fold also gets the samples left over when n_samples is not evenly divided by n_folds.
+    bounds = [foldi * n_per_fold for foldi in range(n_folds)] + [n_samples]
+    if random_shuffle:
+        rows = np.arange(n_samples)
         np.random.shuffle(rows)  # shuffle the row indices in-place (rows is changed)
-    X = X[rows, :]
-    T = T[rows, :]
+        return [rows[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def join_rows(folds):
+    '''Rows of all of folds from partition_indices, as one slice if they are adjacent slices.'''
+    if all(isinstance(fold, slice) for fold in folds) and all(
+            fold.stop == next_fold.start for fold, next_fold in zip(folds[:-1], folds[1:])):
+        return slice(folds[0].start, folds[-1].stop)
+    return np.concatenate([np.arange(fold.start, fold.stop) if isinstance(fold, slice) else fold for fold in folds])
+
+
+def fold_rows(folds, rotation=0):
+    '''Return (train_rows, validate_rows, test_rows) for folds from partition_indices.  Fold rotation is for
+validation, the next one (wrapping around) is for testing and the rest are for training, so rotations 0 through
+n_folds - 1 use each fold once for validation and once for testing.'''
+    n_folds = len(folds)
+    validate_foldi = rotation % n_folds
+    test_foldi = (rotation + 1) % n_folds
+    train_folds = [fold for foldi, fold in enumerate(folds) if foldi not in (validate_foldi, test_foldi)]
+    return join_rows(train_folds), folds[validate_foldi], folds[test_foldi]
 
-#     n_folds = 5
-    n_samples = X.shape[0]
-    n_per_fold = n_samples // n_folds # double-slash = "floor division" which rounds down to the nearest number
-    n_last_fold = n_samples - n_per_fold * (n_folds - 1)  # handles case when n_samples not evenly divided by n_folds
-
-    folds = []
-    start = 0
-    for foldi in range(n_folds-1):
-        folds.append( (X[start:start + n_per_fold, :], T[start:start + n_per_fold, :]) )
-        start += n_per_fold
-    folds.append( (X[start:, :], T[start:, :]) )   # Changed in notes 07.2
-    len(folds), len(folds[0]), folds[0][0].shape, folds[0][1].shape
-    
-    Xvalidate, Tvalidate = folds[0]
-    Xtest, Ttest = folds[1]
-    Xtrain, Ttrain = np.vstack([X for (X, _) in folds[2:]]), np.vstack([T for (_, T) in folds[2:]])
-    
-    
-    return Xtrain, Ttrain, Xvalidate, Tvalidate, Xtest, Ttest
+
+def kfold_partitions(X, T, n_folds, random_shuffle=True):
+    '''Generator of (Xtrain, Ttrain, Xvalidate, Tvalidate, Xtest, Ttest) for each of the n_folds rotations
+of fold_rows, all from one shuffle.  Only the partitions of the rotation being used are in memory.'''
+    folds = partition_indices(X.shape[0], n_folds, random_shuffle)
+    for rotation in range(n_folds):
+        train_rows, validate_rows, test_rows = fold_rows(folds, rotation)
+        yield X[train_rows], T[train_rows], X[validate_rows], T[validate_rows], X[test_rows], T[test_rows]
+
+
+def partition(X, T, n_folds, random_shuffle=True):
+    '''Return Xtrain, Ttrain, Xvalidate, Tvalidate, Xtest, Ttest, with the first of n_folds folds for validation,
+the second for testing and the rest for training.  Each sample is copied once if random_shuffle, and
+the partitions are views of X and T if not.'''
+    return next(kfold_partitions(X, T, n_folds, random_shuffle))
 
 
 # Write a function named `run_experiment` that uses three nested for loops to try different values of the parameters `n_epochs`, `n_hidden_units_per_layer` and `activation_function` which will just be either `tanh` or `relu`. Don't forget to try `[0]` for one of the values of `n_hidden_units_per_layer` to include a linear model in your tests.  For each set of parameter values, create and train a neural network using the 'adam' optimization method and use the neural network on the training, validation and test sets.  Collect the parameter values and the RMSE for the training, validation, and test set in a list.  When your loops are done, construct a `pandas.DataFrame` from the list of results, for easy printing.  The first five lines might look like:
@@ -723,12 +1023,6 @@ def run_experiment(X, T, n_folds, n_epochs_choices , n_hidden_units_per_layer_ch
 # In[17]:
 
 
-df
-data = df.values
-# print(data)
-# print(data.shape)
-
-data = df.iloc[:, :-1].values
 # print(data.shape)
 X = data[:, 1:]
 T = data[:, 0:1]
@@ -772,7 +1066,7 @@ relu_df = result_df[ result_df['activation_function'] == 'relu']
 relu_train = relu_df[['RMSE Train']]
 relu_val = relu_df[['RMSE Val']]
 relu_test = relu_df[['RMSE Test']]
-xticks = result_df[['epochs', 'layer']].apply(lambda x: f'{x[0]}, {x[1]}', axis=1)
+xticks = result_df[['epochs', 'layer']].apply(lambda x: f'{x.iloc[0]}, {x.iloc[1]}', axis=1)
 plt.xticks(range(len(xticks)), xticks, rotation=45, ha='right')
 plt.plot(relu_train, label = 'train relu')
 plt.plot(relu_val, label = 'val relu')
@@ -788,7 +1082,7 @@ tanh_df = result_df[ result_df['activation_function'] == 'tanh']
 tanh_train = tanh_df[['RMSE Train']]
 tanh_val = tanh_df[['RMSE Val']]
 tanh_test = tanh_df[['RMSE Test']]
-xticks = result_df[['epochs', 'layer']].apply(lambda x: f'{x[0]}, {x[1]}', axis=1)
+xticks = result_df[['epochs', 'layer']].apply(lambda x: f'{x.iloc[0]}, {x.iloc[1]}', axis=1)
 plt.xticks(range(len(xticks)), xticks, rotation=45, ha='right') 
 plt.plot(tanh_train, label='train tanh')
 plt.plot(tanh_val, label='val tanh')
@@ -838,13 +1132,71 @@ import math
 # In[22]:
 
 
-class NeuralNetwork():
+import json
+import os
 
 
-    def __init__(self, n_inputs, n_hiddens_per_layer, n_outputs, activation_function='tanh'):
+class RunningStats():
+
+    def __init__(self):
+        '''Mean and standard deviation of the rows of arrays given one at a time to update.  Each array's
+own mean and sum of squared differences from it are combined with those of the earlier ones (Chan, Golub and
+LeVeque's form of Welford's algorithm), which stays accurate for many samples with a large mean.'''
+        self.n_samples = 0
+        self.mean = 0.0
+        self.sum_squares = 0.0  # sum of squared differences from the mean
+
+    def update(self, X):
+        X = np.asarray(X)
+        if X.shape[0] == 0:
+            return
+        mean = X.mean(axis=0, dtype=np.float64)
+        sum_squares = np.sum((X - mean) ** 2, axis=0, dtype=np.float64)
+        self.merge(X.shape[0], mean, sum_squares)
+
+    def merge(self, n_samples, mean, sum_squares):
+        '''Include n_samples samples with the given mean and sum of squared differences from it.'''
+        total = self.n_samples + n_samples
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n_samples / total)
+        self.sum_squares = self.sum_squares + sum_squares + delta ** 2 * (self.n_samples * n_samples / total)
+        self.n_samples = total
+
+    def std(self):
+        '''Standard deviation with n_samples in the denominator, as np.std.'''
+        return np.sqrt(self.sum_squares / self.n_samples)
+
+
+class NeuralNetwork():
+
+    # Activation functions for hidden layers by name, as (function, derivative, derivative_from, saves_aux).
+    # A function is given the weighted sums S of a layer and returns the layer's outputs Y.  The derivative of
+    # Y with respect to S is calculated from S if derivative_from is 'input', or from Y if it is 'output'.
+    # Both also accept an out array to fill.  If saves_aux is True, the function is also given an aux array
+    # shaped like S, in which it saves an intermediate result, such as sigmoid(S) for swish, and the derivative
+    # is given the same aux array rather than calculating that again.  The derivative may overwrite aux.
+    # Method names are looked up on the NeuralNetwork, and other activation functions can be added with
+    # functions in place of the names.
+    activation_functions = {'tanh': ('tanh', 'grad_tanh', 'output', False),
+                            'relu': ('relu', 'grad_relu', 'output', False),
+                            'swish': ('swish', 'grad_swish', 'output', True),
+                            'gelu': ('gelu', 'grad_gelu', 'input', True)}
+
+    # A Profiler to time forward_pass and backpropagate for each layer, and the phases of each epoch of training.
+    profiler = None
+
+    def __init__(self, n_inputs, n_hiddens_per_layer, n_outputs, activation_function='tanh',
+                 dtype=np.float64, optimizer_dtype=None, all_weights=None):
+        '''activation_function: name of the activation function for all hidden layers, or a list of names,
+                     one for each hidden layer
+dtype: type of the weights, gradients and layer outputs, such as np.float32 to halve memory traffic
+optimizer_dtype: type of the optimizer's arrays, such as adam's mt and vt.  Defaults to dtype.
+all_weights: if given, vector of weights used, without copying, in place of randomly initialized ones'''
         self.n_inputs = n_inputs
         self.n_outputs = n_outputs
         self.activation_function = activation_function
+        self.dtype = np.dtype(dtype)
+        self.optimizer_dtype = optimizer_dtype
 
         # Set self.n_hiddens_per_layer to [] if argument is 0, [], or [0]
         if n_hiddens_per_layer == 0 or n_hiddens_per_layer == [] or n_hiddens_per_layer == [0]:
@@ -852,6 +1204,8 @@ class NeuralNetwork():
         else:
             self.n_hiddens_per_layer = n_hiddens_per_layer
 
+        self.setup_activations(activation_function)
+
         # Initialize weights, by first building list of all weight matrix shapes.
         n_in = n_inputs
         shapes = []
@@ -862,35 +1216,88 @@ class NeuralNetwork():
 
         # self.all_weights:  vector of all weights
         # self.Ws: list of weight matrices by layer
-        self.all_weights, self.Ws = self.make_weights_and_views(shapes)
+        self.shapes = shapes
+        if all_weights is None:
+            self.all_weights, self.Ws = self.make_weights_and_views(shapes)
+        else:
+            if all_weights.shape != (sum(shape[0] * shape[1] for shape in shapes),):
+                raise Exception(f'all_weights must be a vector of {sum(shape[0] * shape[1] for shape in shapes)} weights')
+            self.all_weights, self.Ws = all_weights, self.make_views(all_weights, shapes)
 
         # Define arrays to hold gradient values.
         # One array for each W array with same shape.
-        self.all_gradients, self.dE_dWs = self.make_weights_and_views(shapes)
+        if all_weights is None:
+            self.all_gradients, self.dE_dWs = self.make_weights_and_views(shapes)
+        else:
+            self.all_gradients = np.zeros(all_weights.shape, dtype=self.dtype)
+            self.dE_dWs = self.make_views(self.all_gradients, shapes)
 
+        self.setup_state()
+
+
+    def setup_activations(self, activation_function):
+        '''Look up activation functions once, so forward_pass and backpropagate do not compare names every epoch.
+self.activations: list of (function, derivative, derivative_from_input, saves_aux) for each hidden layer'''
+        if isinstance(activation_function, str):
+            activation_function = [activation_function] * len(self.n_hiddens_per_layer)
+        if len(activation_function) != len(self.n_hiddens_per_layer):
+            raise Exception('activation_function must be a name or a list of one name for each hidden layer')
+        self.activation_names = list(activation_function)
+        self.activations = [self.get_activation(name) for name in activation_function]
+
+
+    def setup_state(self):
+        '''Set the training state of a new network.'''
         self.trained = False
         self.total_epochs = 0
         self.error_trace = []
+        # Kept between calls to train, so training can continue where it stopped.
+        self.optimizer = None
+        self.optimizer_method = None
         self.Xmeans = None
         self.Xstds = None
         self.Tmeans = None
         self.Tstds = None
+        # RunningStats of the samples the standardization parameters are from, for update_standardization
+        self.Xstats = None
+        self.Tstats = None
+        # InferencePlan built by freeze for predict
+        self.frozen = None
+
+        # Arrays filled in place by forward_pass and backpropagate, by number of samples.
+        # None unless training was asked to use workspaces.
+        self.workspaces = None
+
+
+    def get_activation(self, name):
+        if name not in self.activation_functions:
+            raise Exception(f'activation_function must be one of {list(self.activation_functions)}, not {name!r}')
+        f, df, derivative_from, saves_aux = self.activation_functions[name]
+        if derivative_from not in ('input', 'output'):
+            raise Exception(f"derivative_from of {name!r} must be 'input' or 'output'")
+        f = getattr(self, f) if isinstance(f, str) else f
+        df = getattr(self, df) if isinstance(df, str) else df
+        return f, df, derivative_from == 'input', bool(saves_aux)
 
 
     def make_weights_and_views(self, shapes):
         # vector of all weights built by horizontally stacking flatenned matrices
         # for each layer initialized with uniformly-distributed values.
         all_weights = np.hstack([np.random.uniform(size=shape).flat / np.sqrt(shape[0])
-                                 for shape in shapes])
-        # Build list of views by reshaping corresponding elements from vector of all weights
-        # into correct shape for each layer.
+                                 for shape in shapes]).astype(self.dtype, copy=False)
+        return all_weights, self.make_views(all_weights, shapes)
+
+    def make_views(self, all_weights, shapes):
+        '''Build list of views by reshaping corresponding elements from vector of all weights
+into correct shape for each layer.  If all_weights has more than one dimension, the views
+are taken along its last one.'''
         views = []
         start = 0
         for shape in shapes:
             size =shape[0] * shape[1]
-            views.append(all_weights[start:start + size].reshape(shape))
+            views.append(all_weights[..., start:start + size].reshape(all_weights.shape[:-1] + shape))
             start += size
-        return all_weights, views
+        return views
 
 
     # Return string that shows how the constructor was called
@@ -904,70 +1311,507 @@ class NeuralNetwork():
             return self.__repr__() + f' trained for {self.total_epochs} epochs, final training error {self.error_trace[-1]}'
 
 
-    def train(self, X, T, n_epochs, learning_rate, method='sgd'):
+    def train(self, X, T, n_epochs, learning_rate, method='sgd', batch_size=None, checkpoint_epochs=None,
+              workspace=False, Xvalidate=None, Tvalidate=None, patience=None, evaluation_interval=1, schedule=None,
+              checkpoint_file=None, checkpoint_interval=None, standardized=False, update_standardization=False):
         '''
 train: 
   X: n_samples x n_inputs matrix of input samples, one per row
   T: n_samples x n_outputs matrix of target output values, one sample per row
   n_epochs: number of passes to take through all samples updating weights each pass
   learning_rate: factor controlling the step size of each update
-  method: is either 'sgd' or 'adam'
+  method: name of an optimization method in Optimizers.methods: 'sgd', 'momentum', 'nesterov', 'rmsprop',
+          'adam', 'adamw' or 'lbfgs'
+  batch_size: if given, samples are shuffled each epoch and weights are updated once for every
+              batch_size samples, rather than once per epoch
+  checkpoint_epochs: if given, a copy of all_weights is saved in self.checkpoints[epoch] at the end of
+                     each of these epochs
+  workspace: if True, layer outputs, weighted sums and deltas are kept in arrays allocated once per
+             batch shape and reused every epoch, instead of allocating new ones each epoch
+  Xvalidate, Tvalidate: if given, RMSE of these samples is calculated every evaluation_interval epochs, at
+             each of checkpoint_epochs and at the last epoch, and appended to self.validation_error_trace as
+             (epoch, RMSE).  When training ends all_weights are set to the weights with the lowest RMSE, from
+             epoch self.best_epoch, and checkpoints hold the best weights up to their epoch.
+  patience: if given with Xvalidate and Tvalidate, training stops when validation RMSE has not improved
+            for patience epochs
+  evaluation_interval: number of epochs between calculations of validation RMSE
+  schedule: name of a learning rate schedule in Optimizers.schedules, or a function called as
+            f(epoch, n_epochs, learning_rate) that returns the learning rate for each epoch
+  checkpoint_file: if given, the weights, optimizer state, epoch, random number generator state,
+                   standardization parameters and error traces are saved in this .npz file every
+                   checkpoint_interval epochs and at the end.  If the file exists when train is called, training
+                   resumes from it, running only the epochs up to n_epochs that were not done yet.  Giving
+                   the same arguments again then continues the run exactly as if it had not stopped, except
+                   for lbfgs, which starts a new history.  Delete the file to start a new run.
+  checkpoint_interval: number of epochs between saves to checkpoint_file, by default n_epochs // 10
+  standardized: if True, X and T are already standardized with self.Xmeans, self.Xstds, self.Tmeans and
+                self.Tstds, which must be set, so they are used as they are instead of standardized again
+  update_standardization: if True and the standardization parameters are already set, they are updated to
+                          include X and T by update_standardization before training
+
+Calling train again continues from the current weights and optimizer state, if method is the same.
+Each call's errors are appended to self.error_trace and its epochs added to self.total_epochs.
         '''
 
-        # Setup standardization parameters
-        if self.Xmeans is None:
-            self.Xmeans = X.mean(axis=0)
-            self.Xstds = X.std(axis=0)
-            self.Xstds[self.Xstds == 0] = 1  # So we don't divide by zero when standardizing
-            self.Tmeans = T.mean(axis=0)
-            self.Tstds = T.std(axis=0)
-            
-        # Standardize X and T
-        X = (X - self.Xmeans) / self.Xstds
-        T = (T - self.Tmeans) / self.Tstds
+        start_epoch = 0
+        resumed_best_weights = None
+        resumed = False
+        if checkpoint_file is not None:
+            if checkpoint_interval is None:
+                checkpoint_interval = max(1, n_epochs // 10)
+            if os.path.exists(checkpoint_file):
+                start_epoch, resumed_best_weights = self.load_checkpoint(checkpoint_file)
+                resumed = True
+        previous_error_trace = list(self.error_trace)
+        previous_total_epochs = self.total_epochs
+
+        if standardized:
+            if self.Xmeans is None:
+                raise Exception('standardized=True requires Xmeans, Xstds, Tmeans and Tstds to be set')
+            X = X.astype(self.dtype, copy=False)
+            T = T.astype(self.dtype, copy=False)
+        else:
+            # Setup standardization parameters
+            if self.Xmeans is None:
+                self.setup_standardization(X, T)
+            elif update_standardization and not resumed:
+                # A resumed run's checkpoint already has the standardization parameters updated with X and T.
+                self.update_standardization(X, T)
+
+            # Standardize X and T
+            X = self.standardize_X(X)
+            T = self.standardize_T(T)
+
+        validate = Xvalidate is not None
+        if validate:
+            if resumed_best_weights is not None:
+                best_weights = resumed_best_weights
+            else:
+                self.validation_error_trace = []
+                self.best_epoch = 0
+                self.best_validation_error = np.inf
+                best_weights = self.all_weights.copy()
+        if checkpoint_epochs is not None and not resumed:
+            self.checkpoints = {}
+        run_error_trace = []  # errors of the epochs of this call, for checkpoint_file
+
+        def epoch_callback_f(epoch, error):
+            stop = False
+            if validate and (epoch % evaluation_interval == 0 or epoch == n_epochs or
+                             (checkpoint_epochs is not None and epoch in checkpoint_epochs)):
+                validation_error = np.sqrt(np.mean((Tvalidate - self.use(Xvalidate)) ** 2))
+                self.validation_error_trace.append((epoch, validation_error))
+                if validation_error < self.best_validation_error:
+                    self.best_validation_error = validation_error
+                    self.best_epoch = epoch
+                    best_weights[:] = self.all_weights
+                elif patience is not None and epoch - self.best_epoch >= patience:
+                    stop = True
+            if checkpoint_epochs is not None and epoch in checkpoint_epochs:
+                self.checkpoints[epoch] = (best_weights if validate else self.all_weights).copy()
+            if checkpoint_file is not None:
+                run_error_trace.append(error)
+                if epoch % checkpoint_interval == 0 or epoch == n_epochs or stop:
+                    self.save_checkpoint(checkpoint_file, epoch, previous_error_trace + run_error_trace,
+                                         previous_total_epochs + len(run_error_trace),
+                                         best_weights if validate else None,
+                                         self.checkpoints if checkpoint_epochs is not None else None)
+            return stop
+
+        if not validate and checkpoint_epochs is None and checkpoint_file is None:
+            epoch_callback_f = None
+
+        if batch_size is None:
+            self.optimize(method, n_epochs, learning_rate, fargs=[X, T], epoch_callback_f=epoch_callback_f,
+                          workspace=workspace, schedule=schedule, start_epoch=start_epoch)
+        else:
+            self.optimize(method, n_epochs, learning_rate,
+                          batches_f=lambda: self.make_batches(X, T, batch_size),
+                          epoch_callback_f=epoch_callback_f, workspace=workspace, schedule=schedule,
+                          start_epoch=start_epoch)
+
+        if validate:
+            self.all_weights[:] = best_weights
+            if checkpoint_epochs is not None:
+                # Training may have stopped before reaching some checkpoints.
+                for epoch in checkpoint_epochs:
+                    if epoch not in self.checkpoints:
+                        self.checkpoints[epoch] = best_weights.copy()
 
-        # Instantiate Optimizers object by giving it vector of all weights
-        optimizer = Optimizers(self.all_weights)
+        # Return neural network object to allow applying other methods after training.
+        #  Example:    Y = nnet.train(X, T, 100, 0.01).use(X)
+        return self
 
-        # Define function to convert value from error_f into error in original T units.
-        error_convert_f = lambda err: (np.sqrt(err) * self.Tstds)[0] # to scalar
+    def train_stream(self, batches, n_epochs, learning_rate, method='sgd', workspace=False):
+        '''
+train_stream: like train, but takes the samples as a sequence of chunks so only one chunk needs to be in memory.
+  batches: iterable of (X, T) chunks of samples that are not standardized, or a function that returns
+           a new such iterable each time it is called.  A generator can only be iterated once, so pass a
+           function that creates it when n_epochs > 1.
+  n_epochs: number of passes to take through all chunks, updating weights once per chunk
+  learning_rate: factor controlling the step size of each update
+  method: name of an optimization method in Optimizers.methods, other than 'lbfgs'
+  workspace: if True, reuse arrays allocated once per chunk shape, as in train
+Standardization parameters, if not already set, are calculated from the first chunk.
+        '''
 
-        if method == 'sgd':
+        batches_f = batches if callable(batches) else lambda: batches
 
-            error_trace = optimizer.sgd(self.error_f, self.gradient_f,
-                                        fargs=[X, T], n_epochs=n_epochs,
-                                        learning_rate=learning_rate,
-                                        error_convert_f=error_convert_f)
+        def standardized_batches_f():
+            for X, T in batches_f():
+                if self.Xmeans is None:
+                    self.setup_standardization(X, T)
+                yield [self.standardize_X(X), self.standardize_T(T)]
 
-        elif method == 'adam':
+        self.optimize(method, n_epochs, learning_rate, batches_f=standardized_batches_f, workspace=workspace)
+        return self
 
-            error_trace = optimizer.adam(self.error_f, self.gradient_f,
-                                         fargs=[X, T], n_epochs=n_epochs,
-                                         learning_rate=learning_rate,
-                                         error_convert_f=error_convert_f)
+    def train_out_of_core(self, X, T, n_epochs, learning_rate, method='sgd', batch_size=10000, shuffle=True,
+                          workspace=False):
+        '''
+train_out_of_core: like train, for X and T too large for memory, such as np.memmap arrays.
+  X, T: arrays, or names of .npy files, which are memory-mapped.  They can be views of one array, such as
+        data[:, 1:] and data[:, 0:1].
+  n_epochs, learning_rate, method, workspace: as for train_stream
+  batch_size: number of consecutive samples in each batch, which is read and standardized only when it is used
+  shuffle: if True, batches are used in a new random order each epoch.  Samples within a batch stay together,
+           so each batch is one sequential read.
+Standardization parameters, if not already set, are calculated from all samples in one streaming pass, so no
+standardized copy of X or T is ever made.
+        '''
 
-        else:
-            raise Exception("method must be 'sgd' or 'adam'")
-        
-        self.error_trace = error_trace
+        if isinstance(X, str):
+            X = np.load(X, mmap_mode='r')
+        if isinstance(T, str):
+            T = np.load(T, mmap_mode='r')
+        if self.Xmeans is None:
+            self.Xstats, self.Tstats = self.running_stats(X, T, batch_size)
+            self.Xmeans, self.Xstds, self.Tmeans, self.Tstds = self.standardization_from_stats(self.Xstats, self.Tstats)
+
+        def batches_f():
+            starts = np.arange(0, X.shape[0], batch_size)
+            if shuffle:
+                np.random.shuffle(starts)
+            for start in starts:
+                yield X[start:start + batch_size], T[start:start + batch_size]
+
+        return self.train_stream(batches_f, n_epochs, learning_rate, method=method, workspace=workspace)
+
+    def setup_standardization(self, X, T):
+        self.Xmeans, self.Xstds, self.Tmeans, self.Tstds = self.standardization_parameters(X, T)
+        self.Xstats, self.Tstats = RunningStats(), RunningStats()
+        self.Xstats.update(X)
+        self.Tstats.update(T)
+
+    def update_standardization(self, X, T):
+        '''Include X and T in the samples the standardization parameters are calculated from, and change the
+weights of the first and last layers so the network calculates the same function of the unstandardized
+inputs as before.  Adam's moments are left as they are.'''
+        if self.Xstats is None:
+            raise Exception('update_standardization requires standardization parameters set by train, train_stream or train_out_of_core')
+        self.Xstats.update(X)
+        self.Tstats.update(T)
+        Xmeans, Xstds, Tmeans, Tstds = self.standardization_from_stats(self.Xstats, self.Tstats)
+
+        # With inputs standardized by the new parameters instead of the old, the first layer gets the same
+        # weighted sums if its input weights are scaled by Xstds / self.Xstds and its biases are shifted by the
+        # new means, standardized with the old parameters, times the old input weights.  The ... indexing
+        # also handles the leading network axis of the weights of NeuralNetworkEnsemble.
+        W = self.Ws[0]
+        W[..., 0, :] += ((Xmeans - self.Xmeans) / self.Xstds) @ W[..., 1:, :]
+        W[..., 1:, :] *= (Xstds / self.Xstds)[:, None]
+        # Outputs of the last layer are unstandardized with the new parameters instead of the old.
+        W = self.Ws[-1]
+        W *= self.Tstds / Tstds
+        W[..., 0, :] += (self.Tmeans - Tmeans) / Tstds
+
+        self.Xmeans, self.Xstds, self.Tmeans, self.Tstds = Xmeans, Xstds, Tmeans, Tstds
+
+    @staticmethod
+    def running_stats(X, T, chunk_rows=100000):
+        '''Return RunningStats of X and of T, from one pass over chunk_rows samples at a time.'''
+        Xstats = RunningStats()
+        Tstats = RunningStats()
+        for start in range(0, X.shape[0], chunk_rows):
+            Xstats.update(X[start:start + chunk_rows])
+            Tstats.update(T[start:start + chunk_rows])
+        return Xstats, Tstats
+
+    @staticmethod
+    def standardization_from_stats(Xstats, Tstats):
+        '''Like standardization_parameters, from RunningStats of X and T.'''
+        Xstds = Xstats.std()
+        Xstds[Xstds == 0] = 1  # So we don't divide by zero when standardizing
+        return Xstats.mean.copy(), Xstds, Tstats.mean.copy(), Tstats.std()
+
+    @staticmethod
+    def standardization_parameters(X, T):
+        '''Return Xmeans, Xstds, Tmeans and Tstds for standardizing X and T.'''
+        Xmeans = X.mean(axis=0)
+        Xstds = X.std(axis=0)
+        Xstds[Xstds == 0] = 1  # So we don't divide by zero when standardizing
+        Tmeans = T.mean(axis=0)
+        Tstds = T.std(axis=0)
+        return Xmeans, Xstds, Tmeans, Tstds
+
+    def save_checkpoint(self, filename, epoch, error_trace, total_epochs, best_weights=None, checkpoints=None):
+        '''Write everything train needs to resume after epoch of the current run to filename, as a .npz file,
+including the weights in checkpoints saved for checkpoint_epochs so far.  The file is replaced only once the
+new one is complete, so a run stopped while saving keeps the last one.'''
+        optimizer = self.optimizer
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+        checkpoint = {'all_weights': self.all_weights,
+                      'method': self.optimizer_method,
+                      'mt': optimizer.mt,
+                      'vt': optimizer.vt,
+                      'beta1t': optimizer.beta1t,
+                      'beta2t': optimizer.beta2t,
+                      'epoch': epoch,
+                      'total_epochs': total_epochs,
+                      'error_trace': np.array(error_trace, dtype=np.float64),
+                      'rng_keys': rng_keys,
+                      'rng_pos': rng_pos,
+                      'rng_has_gauss': rng_has_gauss,
+                      'rng_cached_gaussian': rng_cached_gaussian,
+                      'Xmeans': self.Xmeans,
+                      'Xstds': self.Xstds,
+                      'Tmeans': self.Tmeans,
+                      'Tstds': self.Tstds}
+        if self.Xstats is not None:
+            checkpoint.update({'stats_n_samples': self.Xstats.n_samples,
+                               'Xstats_mean': self.Xstats.mean,
+                               'Xstats_sum_squares': self.Xstats.sum_squares,
+                               'Tstats_mean': self.Tstats.mean,
+                               'Tstats_sum_squares': self.Tstats.sum_squares})
+        if best_weights is not None:
+            checkpoint.update({'best_weights': best_weights,
+                               'best_epoch': self.best_epoch,
+                               'best_validation_error': self.best_validation_error,
+                               'validation_error_trace': np.array(self.validation_error_trace,
+                                                                  dtype=np.float64).reshape((-1, 2))})
+        if checkpoints:
+            epochs = sorted(checkpoints)
+            checkpoint.update({'checkpoint_epochs': np.array(epochs),
+                               'checkpoint_weights': np.stack([checkpoints[e] for e in epochs])})
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, **checkpoint)
+        os.replace(filename + '.tmp', filename)
+
+    def load_checkpoint(self, filename):
+        '''Restore the state saved by save_checkpoint, including self.checkpoints.  Returns the epoch of the run
+it was saved after, and the best weights found by validation, or None if it was saved without validation.'''
+        with np.load(filename) as checkpoint:
+            self.all_weights[:] = checkpoint['all_weights']
+            self.optimizer = Optimizers(self.all_weights, dtype=self.optimizer_dtype)
+            self.optimizer_method = str(checkpoint['method'])
+            self.optimizer.mt[:] = checkpoint['mt']
+            self.optimizer.vt[:] = checkpoint['vt']
+            self.optimizer.beta1t = float(checkpoint['beta1t'])
+            self.optimizer.beta2t = float(checkpoint['beta2t'])
+            self.total_epochs = int(checkpoint['total_epochs'])
+            self.error_trace = list(checkpoint['error_trace'])
+            self.trained = True
+            np.random.set_state(('MT19937', checkpoint['rng_keys'], int(checkpoint['rng_pos']),
+                                 int(checkpoint['rng_has_gauss']), float(checkpoint['rng_cached_gaussian'])))
+            self.Xmeans, self.Xstds = checkpoint['Xmeans'], checkpoint['Xstds']
+            self.Tmeans, self.Tstds = checkpoint['Tmeans'], checkpoint['Tstds']
+            self.Xstats = self.Tstats = None
+            if 'stats_n_samples' in checkpoint:
+                n_samples = int(checkpoint['stats_n_samples'])
+                self.Xstats, self.Tstats = RunningStats(), RunningStats()
+                self.Xstats.merge(n_samples, checkpoint['Xstats_mean'], checkpoint['Xstats_sum_squares'])
+                self.Tstats.merge(n_samples, checkpoint['Tstats_mean'], checkpoint['Tstats_sum_squares'])
+            self.checkpoints = {}
+            if 'checkpoint_epochs' in checkpoint:
+                for epoch, weights in zip(checkpoint['checkpoint_epochs'], checkpoint['checkpoint_weights']):
+                    self.checkpoints[int(epoch)] = weights
+            best_weights = None
+            if 'best_weights' in checkpoint:
+                best_weights = checkpoint['best_weights']
+                self.best_epoch = int(checkpoint['best_epoch'])
+                self.best_validation_error = float(checkpoint['best_validation_error'])
+                self.validation_error_trace = [(int(epoch), error) for epoch, error in checkpoint['validation_error_trace']]
+            return int(checkpoint['epoch']), best_weights
+
+    def save(self, filename):
+        '''Write the architecture, all_weights and standardization parameters to filename.
+The file starts with one line of JSON describing the network, padded to a multiple of 64 bytes,
+followed by all_weights and then Xmeans, Xstds, Tmeans and Tstds as float64.  If the JSON's stats_n_samples
+is not null, these are followed by the means and sums of squares of Xstats and then of Tstats, the
+RunningStats that update_standardization continues from.'''
+        if self.Xmeans is None:
+            raise Exception('NeuralNetwork must be trained before it is saved')
+        stats = [self.Xmeans, self.Xstds, self.Tmeans, self.Tstds]
+        if self.Xstats is not None:
+            stats += [self.Xstats.mean, self.Xstats.sum_squares, self.Tstats.mean, self.Tstats.sum_squares]
+        stats = np.hstack(stats).astype(np.float64)
+        header = {'n_inputs': self.n_inputs,
+                  'n_hiddens_per_layer': list(self.n_hiddens_per_layer),
+                  'n_outputs': self.n_outputs,
+                  'activation_function': self.activation_function,
+                  'dtype': self.dtype.str,
+                  'n_weights': self.all_weights.size,
+                  'total_epochs': self.total_epochs,
+                  'stats_n_samples': None if self.Xstats is None else int(self.Xstats.n_samples)}
+        header = json.dumps(header).encode()
+        header += b' ' * (-(len(header) + 1) % 64) + b'\n'
+        with open(filename, 'wb') as f:
+            f.write(header)
+            f.write(np.ascontiguousarray(self.all_weights).tobytes())
+            f.write(stats.tobytes())
+
+    @classmethod
+    def load(cls, filename, mode='r'):
+        '''Return NeuralNetwork saved in filename by save.  all_weights is memory-mapped from the file
+and Ws are views of it, so processes loading the same file share one copy of the weights.
+mode is as for np.memmap: 'r' for read-only weights, 'c' to allow training without changing the file,
+or 'r+' to train and write the new weights to the file.'''
+        with open(filename, 'rb') as f:
+            header_line = f.readline()
+        header = json.loads(header_line)
+        dtype = np.dtype(header['dtype'])
+        n_weights = header['n_weights']
+        all_weights = np.memmap(filename, dtype=dtype, mode=mode, offset=len(header_line), shape=(n_weights,))
+        nnet = cls(header['n_inputs'], header['n_hiddens_per_layer'], header['n_outputs'],
+                   header['activation_function'], dtype=dtype, all_weights=all_weights)
+        n_inputs, n_outputs = header['n_inputs'], header['n_outputs']
+        stats_n_samples = header.get('stats_n_samples')
+        n_stats = 2 * (n_inputs + n_outputs)
+        stats = np.fromfile(filename, dtype=np.float64, count=n_stats if stats_n_samples is None else 2 * n_stats,
+                            offset=len(header_line) + n_weights * dtype.itemsize)
+        splits = np.cumsum([n_inputs, n_inputs, n_outputs])
+        nnet.Xmeans, nnet.Xstds, nnet.Tmeans, nnet.Tstds = np.split(stats[:n_stats], splits)
+        if stats_n_samples is not None:
+            Xmean, Xsum_squares, Tmean, Tsum_squares = np.split(stats[n_stats:], splits)
+            nnet.Xstats, nnet.Tstats = RunningStats(), RunningStats()
+            nnet.Xstats.merge(stats_n_samples, Xmean, Xsum_squares)
+            nnet.Tstats.merge(stats_n_samples, Tmean, Tsum_squares)
+        nnet.total_epochs = header['total_epochs']
+        nnet.trained = True
+        return nnet
+
+    def standardize_X(self, X):
+        return ((X - self.Xmeans) / self.Xstds).astype(self.dtype, copy=False)
+
+    def standardize_T(self, T):
+        return ((T - self.Tmeans) / self.Tstds).astype(self.dtype, copy=False)
+
+    def make_batches(self, X, T, batch_size):
+        '''Generator of [X, T] batches of standardized samples in a new random order.'''
+        rows = np.random.permutation(X.shape[0])
+        for start in range(0, X.shape[0], batch_size):
+            batch_rows = rows[start:start + batch_size]
+            yield [X[batch_rows, :], T[batch_rows, :]]
+
+    def optimize(self, method, n_epochs, learning_rate, fargs=[], batches_f=None, epoch_callback_f=None,
+                 workspace=False, schedule=None, start_epoch=0):
+        '''Run the optimizer named by method on standardized data given by fargs or batches_f, for epochs
+start_epoch to n_epochs.  The optimizer is kept in self.optimizer to continue from in the next call,
+unless that call gives a different method.'''
+
+        if workspace:
+            self.workspaces = {}
 
-        # Return neural network object to allow applying other methods after training.
-        #  Example:    Y = nnet.train(X, T, 100, 0.01).use(X)
-        return self
+        # Instantiate Optimizers object by giving it vector of all weights
+        if self.optimizer is None or self.optimizer_method != method:
+            self.optimizer = Optimizers(self.all_weights, dtype=self.optimizer_dtype)
+            self.optimizer_method = method
+        optimizer = self.optimizer
+        optimizer.profiler = self.profiler
+        optimizer.schedule = Optimizers.get_schedule(schedule)
+        optimizer.start_epoch = start_epoch
+
+        # Define function to convert value from error_f into error in original T units.
+        error_convert_f = lambda err: (np.sqrt(err) * self.Tstds)[0] # to scalar
+
+        error_trace = optimizer.run_method(method, self.error_f, self.gradient_f,
+                                           error_gradient_f=self.error_and_gradient,
+                                           fargs=fargs, n_epochs=n_epochs,
+                                           learning_rate=learning_rate,
+                                           error_convert_f=error_convert_f,
+                                           batches_f=batches_f,
+                                           epoch_callback_f=epoch_callback_f)
+
+        self.error_trace += error_trace
+        self.total_epochs += len(error_trace)
+        self.trained = True
+        self.workspaces = None
+
+    def make_workspace(self, n_samples):
+        '''Arrays for forward_pass and backpropagate to fill in place for batches of n_samples samples.'''
+        n_units = self.n_hiddens_per_layer + [self.n_outputs]
+        empty = lambda n_units: np.empty((n_samples, n_units), dtype=self.dtype)
+        return {'Ys': [None] + [empty(nu) for nu in n_units],   # Ys[0] will be X
+                'Ss': [empty(nu) for nu in n_units[:-1]],       # weighted sums into each hidden layer
+                'auxs': [empty(nu) if saves_aux else None        # saved by activation functions for derivatives
+                         for nu, (f, df, derivative_from_input, saves_aux) in zip(n_units, self.activations)],
+                'dYs': [empty(nu) for nu in n_units[:-1]],      # derivatives of hidden layer outputs
+                'deltas': [empty(nu) for nu in n_units],
+                'error': empty(self.n_outputs)}
+
+    def get_workspace(self, n_samples):
+        if n_samples not in self.workspaces:
+            self.workspaces[n_samples] = self.make_workspace(n_samples)
+        return self.workspaces[n_samples]
 
    
     def forward_pass(self, X):
         '''X assumed already standardized. Output returned as standardized.'''
+        if self.workspaces is not None:
+            return self.forward_pass_in_place(X)
+        profiler = self.profiler
         self.Ys = [X]
-        for W in self.Ws[:-1]:
-            if self.activation_function == "tanh":
-                self.Ys.append(np.tanh(self.Ys[-1] @ W[1:, :] + W[0:1, :]))
-            elif self.activation_function == "relu":
-                self.Ys.append(self.relu(self.Ys[-1] @ W[1:, :] + W[0:1, :]))
-            elif self.activation_function == "swish":
-                self.Ys.append(self.swish(self.Ys[-1] @ W[1:, :] + W[0:1, :]))
+        self.Ss = []  # weighted sums into each hidden layer, if its derivative is calculated from them
+        self.auxs = []  # arrays saved by each hidden layer's activation function for its derivative
+        for layeri, (W, (f, df, derivative_from_input, saves_aux)) in enumerate(zip(self.Ws[:-1], self.activations)):
+            if profiler is not None:
+                token = profiler.start()
+            S = self.Ys[-1] @ W[1:, :] + W[0:1, :]
+            self.Ss.append(S if derivative_from_input else None)
+            if saves_aux:
+                self.auxs.append(np.empty_like(S))
+                self.Ys.append(f(S, aux=self.auxs[-1]))
+            else:
+                self.auxs.append(None)
+                self.Ys.append(f(S))
+            if profiler is not None:
+                profiler.stop(f'forward layer {layeri}', token)
+        if profiler is not None:
+            token = profiler.start()
         last_W = self.Ws[-1]
         self.Ys.append(self.Ys[-1] @ last_W[1:, :] + last_W[0:1, :])
+        if profiler is not None:
+            profiler.stop(f'forward layer {len(self.Ws) - 1}', token)
+        return self.Ys
+
+    def forward_pass_in_place(self, X):
+        '''forward_pass using the workspace for X.shape[0] samples.  The returned
+Ys are overwritten by the next call with the same number of samples.'''
+        profiler = self.profiler
+        workspace = self.get_workspace(X.shape[0])
+        self.Ys = workspace['Ys']
+        self.Ys[0] = X
+        self.Ss = workspace['Ss']
+        self.auxs = workspace['auxs']
+        for layeri, (W, (f, df, derivative_from_input, saves_aux)) in enumerate(zip(self.Ws[:-1], self.activations)):
+            if profiler is not None:
+                token = profiler.start()
+            S = self.Ss[layeri]
+            np.matmul(self.Ys[layeri], W[1:, :], out=S)
+            S += W[0:1, :]
+            if saves_aux:
+                f(S, out=self.Ys[layeri + 1], aux=self.auxs[layeri])
+            else:
+                f(S, out=self.Ys[layeri + 1])
+            if profiler is not None:
+                profiler.stop(f'forward layer {layeri}', token)
+        if profiler is not None:
+            token = profiler.start()
+        last_W = self.Ws[-1]
+        np.matmul(self.Ys[-2], last_W[1:, :], out=self.Ys[-1])
+        self.Ys[-1] += last_W[0:1, :]
+        if profiler is not None:
+            profiler.stop(f'forward layer {len(self.Ws) - 1}', token)
         return self.Ys
 
     # Function to be minimized by optimizer method, mean squared error
@@ -979,97 +1823,372 @@ train:
     # Gradient of function to be minimized for use by optimizer method
     def gradient_f(self, X, T):
         '''Assumes forward_pass just called with layer outputs in self.Ys.'''
-        error = T - self.Ys[-1]
-        n_samples = X.shape[0]
-        n_outputs = T.shape[1]
+        return self.backpropagate(T - self.Ys[-1])
+
+    # Function to be minimized and its gradient, from one forward pass, for use by optimizer method
+    def error_and_gradient(self, X, T):
+        Ys = self.forward_pass(X)
+        if self.workspaces is not None:
+            workspace = self.get_workspace(X.shape[0])
+            error = np.subtract(T, Ys[-1], out=workspace['error'])
+            # The last delta is overwritten by backpropagate, so it can hold the squared errors until then.
+            mean_sq_error = np.mean(np.square(error, out=workspace['deltas'][-1]), dtype=np.float64)
+        else:
+            error = T - Ys[-1]
+            mean_sq_error = np.mean(error ** 2, dtype=np.float64)
+        return mean_sq_error, self.backpropagate(error)
+
+    def backpropagate(self, error):
+        '''error is T - self.Ys[-1] for the samples last given to forward_pass.'''
+        if self.workspaces is not None:
+            return self.backpropagate_in_place(error)
+        profiler = self.profiler
+        n_samples, n_outputs = error.shape
         delta = - error / (n_samples * n_outputs)
         n_layers = len(self.n_hiddens_per_layer) + 1
         # Step backwards through the layers to back-propagate the error (delta)
         for layeri in range(n_layers - 1, -1, -1):
+            if profiler is not None:
+                token = profiler.start()
             # gradient of all but bias weights
             self.dE_dWs[layeri][1:, :] = self.Ys[layeri].T @ delta
             # gradient of just the bias weights
-            self.dE_dWs[layeri][0:1, :] = np.sum(delta, 0)
-            # Back-propagate this layer's delta to previous layer
-            if self.activation_function == "tanh":
-                delta = delta @ self.Ws[layeri][1:, :].T * (1 - self.Ys[layeri] ** 2)
-            elif self.activation_function == "relu":
-                delta = delta @ self.Ws[layeri][1:, :].T * self.grad_relu(self.Ys[layeri])
-            elif self.activation_function == "swish":
-                delta = delta @ self.Ws[layeri][1:, :].T * self.grad_swish(self.Ys[layeri])
+            self.dE_dWs[layeri][0:1, :] = np.sum(delta, 0, dtype=np.float64)
+            if layeri > 0:  # no delta is needed for the inputs
+                # Back-propagate this layer's delta to previous layer
+                f, df, derivative_from_input, saves_aux = self.activations[layeri - 1]
+                S_or_Y = self.Ss[layeri - 1] if derivative_from_input else self.Ys[layeri]
+                dY = df(S_or_Y, aux=self.auxs[layeri - 1]) if saves_aux else df(S_or_Y)
+                delta = delta @ self.Ws[layeri][1:, :].T * dY
+            if profiler is not None:
+                profiler.stop(f'backpropagate layer {layeri}', token)
+        return self.all_gradients
+
+    def backpropagate_in_place(self, error):
+        '''backpropagate using the workspace for error.shape[0] samples.'''
+        n_samples, n_outputs = error.shape
+        workspace = self.get_workspace(n_samples)
+        deltas = workspace['deltas']
+        np.divide(error, -(n_samples * n_outputs), out=deltas[-1])
+        profiler = self.profiler
+        n_layers = len(self.n_hiddens_per_layer) + 1
+        for layeri in range(n_layers - 1, -1, -1):
+            if profiler is not None:
+                token = profiler.start()
+            delta = deltas[layeri]
+            np.matmul(self.Ys[layeri].T, delta, out=self.dE_dWs[layeri][1:, :])
+            np.sum(delta, 0, dtype=np.float64, out=self.dE_dWs[layeri][0, :])
+            if layeri > 0:  # no delta is needed for the inputs
+                f, df, derivative_from_input, saves_aux = self.activations[layeri - 1]
+                S_or_Y = self.Ss[layeri - 1] if derivative_from_input else self.Ys[layeri]
+                dY = workspace['dYs'][layeri - 1]
+                if saves_aux:
+                    df(S_or_Y, out=dY, aux=self.auxs[layeri - 1])
+                else:
+                    df(S_or_Y, out=dY)
+                np.matmul(delta, self.Ws[layeri][1:, :].T, out=deltas[layeri - 1])
+                deltas[layeri - 1] *= dY
+            if profiler is not None:
+                profiler.stop(f'backpropagate layer {layeri}', token)
         return self.all_gradients
 
     def use(self, X):
         '''X assumed to not be standardized. Return the unstandardized prediction'''
-        Xstd = (X - self.Xmeans) / self.Xstds
+        Xstd = self.standardize_X(X)
         Y = self.forward_pass(Xstd)
         Yunstd= (Y[-1] * self.Tstds) + self.Tmeans
         return Yunstd
+
+    def freeze(self):
+        '''Build self.frozen, an InferencePlan for predict from a copy of the current weights, with standardization
+of the inputs folded into the first layer and unstandardization of the outputs folded into the last layer.
+Call again after more training.'''
+        Ws = [W.astype(np.float64) for W in self.Ws]
+        # (X - Xmeans) / Xstds @ W[1:] + W[0] = X @ (W[1:] / Xstds) + (W[0] - Xmeans / Xstds @ W[1:])
+        first_W = Ws[0]
+        first_W[0, :] -= (self.Xmeans / self.Xstds) @ first_W[1:, :]
+        first_W[1:, :] /= self.Xstds.reshape(-1, 1)
+        # (Y @ W[1:] + W[0]) * Tstds + Tmeans = Y @ (W[1:] * Tstds) + (W[0] * Tstds + Tmeans)
+        last_W = Ws[-1]
+        last_W *= self.Tstds
+        last_W[0, :] += self.Tmeans
+        self.frozen = InferencePlan([(W[1:, :], W[0, :]) for W in Ws], self.activation_names,
+                                    [f for f, df, derivative_from_input, saves_aux in self.activations], self.dtype)
+        return self
+
+    def predict(self, X):
+        '''Like use, but with the weights from the last call to freeze.  Does not change the NeuralNetwork or keep
+any layer outputs, so can be called from several threads at once.'''
+        if self.frozen is None:
+            raise Exception('NeuralNetwork must be frozen with freeze() before predict is called')
+        return self.frozen.predict(X)
     
-    def relu(self, s): 
-        Y = s.copy()
-        Y[Y < 0] = 0
-        return Y
+    def tanh(self, s, out=None):
+        return np.tanh(s, out=out)
+
+    def grad_tanh(self, Y, out=None):
+        '''Y is tanh(s)'''
+        out = np.multiply(Y, Y, out=out)
+        return np.subtract(1, out, out=out)
+
+    def relu(self, s, out=None): 
+        return np.maximum(s, 0, out=out)
     
-    def grad_relu(self, s):
-        dY = s.copy()
-        dY[s < 0] = 0 #not clean oh whelp
-        dY[s > 0] = 1
-        dY[s == 0] = 0
-        return dY
+    def grad_relu(self, Y, out=None):
+        '''Y is relu(s).  Gradient at 0 taken as 0.'''
+        return np.heaviside(Y, 0, out=out)
     
-    def sigmoid(self, number):
-        
-        return 1/(1 + math.exp(-num))
+    def sigmoid(self, s, out=None):
+        '''Calculated as 0.5 * (1 + tanh(s / 2)), which cannot overflow for large |s| as exp(-s) can.'''
+        out = np.multiply(s, 0.5, out=out)
+        np.tanh(out, out=out)
+        out += 1
+        out *= 0.5
+        return out
     
-    def swish(self, s):
-        Y = s.copy()
-        swished = [self.sigmoid(i) for i in Y]
-        return swished
+    def swish(self, s, out=None, aux=None):
+        '''s sigmoid(s).  sigmoid(s) is saved in aux, if given, for grad_swish.'''
+        if aux is None:
+            out = self.sigmoid(s, out=out)
+            out *= s
+            return out
+        self.sigmoid(s, out=aux)
+        return np.multiply(s, aux, out=out)
     
-    def grad_swish(self, s):
-        Y = s.copy()
-        dswish = self.swish(Y) * (1 - self.swish(Y))
-        return dswish
+    def grad_swish(self, Y, out=None, aux=None):
+        '''Y is swish(s) and aux is sigmoid(s), as saved by swish, so s is not needed.
+d swish(s) / ds = sigmoid(s) + s sigmoid(s) (1 - sigmoid(s)) = Y + sigmoid(s) (1 - Y)'''
+        out = np.subtract(1, Y, out=out)
+        out *= aux
+        out += Y
+        return out
+
+    def gelu(self, s, out=None, aux=None):
+        '''GELU using the tanh approximation 0.5 s (1 + tanh(sqrt(2 / pi) (s + 0.044715 s^3))).
+The tanh is saved in aux, if given, for grad_gelu.'''
+        t = self.gelu_tanh(s, out=out if aux is None else aux)
+        out = np.add(t, 1, out=out)
+        out *= s
+        out *= 0.5
+        return out
+
+    def grad_gelu(self, s, out=None, aux=None):
+        '''aux is gelu_tanh(s), as saved by gelu, and is overwritten.'''
+        t = self.gelu_tanh(s) if aux is None else aux
+        # 0.5 (1 + t) + 0.5 s (1 - t^2) sqrt(2 / pi) (1 + 3 0.044715 s^2) = (1 + t) (0.5 + g (1 - t)),
+        # with g = 0.5 s sqrt(2 / pi) (1 + 3 0.044715 s^2), calculated in out and t without temporary arrays.
+        out = np.multiply(s, s, out=out)
+        out *= 3 * 0.044715
+        out += 1
+        out *= np.sqrt(2 / np.pi) * 0.5
+        out *= s
+        np.subtract(1, t, out=t)
+        out *= t
+        out += 0.5
+        np.subtract(2, t, out=t)
+        out *= t
+        return out
+
+    def gelu_tanh(self, s, out=None):
+        t = np.multiply(s, s, out=out)
+        t *= 0.044715
+        t += 1
+        t *= s
+        t *= np.sqrt(2 / np.pi)
+        return np.tanh(t, out=t)
         
 
 
 # In[23]:
 
 
+import concurrent.futures
+import multiprocessing
+
+
 def rmse(A, B) : 
     return np.sqrt(np.mean((A-B)**2))
 
 
-def run_experiment(X, T, n_folds, n_epochs_choices , n_hidden_units_per_layer_choices, activation_function_choices) : 
+def init_run_config(partitions):
+    '''Gives each worker process the partitioned data once, instead of with every configuration.  For
+cross-validation, partitions is (X, T, folds), with folds from partition_indices, and the partitions of each
+rotation are made by fold_partitions when first needed.'''
+    run_config.partitions = partitions
+    run_config.fold = (None, None)
+
+
+def fold_partitions(foldi):
+    '''Partitions of rotation foldi for cross-validation in run_config, from standardize_partitions.  Only the
+rotation last asked for is kept, so a process holds the partitions of one rotation at a time.'''
+    if run_config.fold[0] != foldi:
+        run_config.fold = (None, None)  # release the previous rotation before making the next
+        X, T, folds = run_config.partitions
+        train_rows, validate_rows, test_rows = fold_rows(folds, foldi)
+        partitions = (X[train_rows], T[train_rows], X[validate_rows], T[validate_rows], X[test_rows], T[test_rows])
+        run_config.fold = (foldi, standardize_partitions(partitions))
+    return run_config.fold[1]
+
+
+def standardize_partitions(partitions):
+    '''Add to partitions from partition the standardization parameters of the training partition, as
+NeuralNetwork.train would calculate them, and the training partition standardized with them.'''
+    Xtrain, Ttrain = partitions[:2]
+    standardization = NeuralNetwork.standardization_parameters(Xtrain, Ttrain)
+    Xmeans, Xstds, Tmeans, Tstds = standardization
+    return partitions + (standardization, (Xtrain - Xmeans) / Xstds, (Ttrain - Tmeans) / Tstds)
+
+
+def run_config(config):
+    '''Train and evaluate one network for run_experiment.  config is (epochs, layer, learn_rate, activation, seed,
+patience, schedule, foldi).  The network is trained for max(epochs) epochs and one result row is returned for each
+value in epochs, using the weights saved at the end of that epoch.  If seed is None, the global random number
+generator is used as it is.  If patience is not None, training stops early when RMSE on the validation set stops
+improving.  If schedule is not None, the learning rate follows it and its name is included in each row after
+activation.  If foldi is not None, the partitions are those of rotation foldi from fold_partitions, and the
+network trains on their standardized training partition.'''
+    epochs, layer, learn_rate, activation, seed, patience, schedule, foldi = config
+    if foldi is None:
+        Xtrain, Ttrain, Xvalidate, Tvalidate, Xtest, Ttest = run_config.partitions
+    else:
+        (Xtrain, Ttrain, Xvalidate, Tvalidate, Xtest, Ttest,
+         standardization, Xtrain_standardized, Ttrain_standardized) = fold_partitions(foldi)
+
+    if seed is not None:
+        np.random.seed(seed)
+
+    adam_sample = NeuralNetwork(Xtrain.shape[1], layer, 1, activation_function = activation)
+    if foldi is None:
+        train_args = (Xtrain, Ttrain)
+    else:
+        adam_sample.Xmeans, adam_sample.Xstds, adam_sample.Tmeans, adam_sample.Tstds = standardization
+        train_args = (Xtrain_standardized, Ttrain_standardized)
+    if patience is None:
+        adam_sample.train(*train_args, max(epochs), learn_rate, method = "adam", checkpoint_epochs = epochs,
+                          schedule = schedule, standardized = foldi is not None)
+    else:
+        adam_sample.train(*train_args, max(epochs), learn_rate, method = "adam", checkpoint_epochs = epochs,
+                          Xvalidate = Xvalidate, Tvalidate = Tvalidate, patience = patience, schedule = schedule,
+                          standardized = foldi is not None)
+
     output = []
+    for epoch in epochs:
+        adam_sample.all_weights[:] = adam_sample.checkpoints[epoch]
+    
+        train_pred = adam_sample.use(Xtrain)
+        validate_pred = adam_sample.use(Xvalidate)
+        test_pred = adam_sample.use(Xtest)
+        
+        train_error = rmse(Ttrain, train_pred)
+        validate_error = rmse(Tvalidate, validate_pred)
+        test_error = rmse(Ttest, test_pred)
+        
+        if schedule is None:
+            output.append([epoch, layer, learn_rate, activation, train_error, validate_error, test_error])
+        else:
+            schedule_name = schedule if isinstance(schedule, str) else schedule.__name__
+            output.append([epoch, layer, learn_rate, activation, schedule_name, train_error, validate_error, test_error])
+    return output
+
+
+def run_experiment(X, T, n_folds, n_epochs_choices , n_hidden_units_per_layer_choices, activation_function_choices,
+                   n_workers=None, epoch_ladder=False, patience=None, learning_rate=.01, schedule_choices=None,
+                   cross_validate=False) : 
+    '''
+n_workers: if None, configurations are trained one after another using the global random number generator.
+           Otherwise each configuration gets its own seed, drawn from the global generator after partitioning,
+           and configurations are trained in a pool of n_workers processes.  Results do not depend on n_workers.
+epoch_ladder: if True, each layer and activation function pair is trained once for the largest of
+              n_epochs_choices, and the results for smaller numbers of epochs are from weights saved along the way.
+patience: if given, training stops once RMSE on the validation set has not improved for this many epochs,
+          and the weights with the lowest validation RMSE are used.
+learning_rate: learning rate for adam, or the largest learning rate of a schedule
+schedule_choices: if given, a list of names from Optimizers.schedules or functions, which are swept over
+                  after activation functions and reported in a schedule column.  With epoch_ladder, each
+                  schedule spans the largest of n_epochs_choices.  With n_workers, functions must be
+                  defined at the top level so they can be sent to the worker processes.
+cross_validate: if True, every configuration is trained once for each of the n_folds rotations of the folds
+                from fold_rows.  Configurations are run one rotation after another, and the partitions,
+                standardization parameters and standardized training partition of a rotation are made once
+                (once per worker process with n_workers) and shared by all configurations of that rotation,
+                so only one rotation's partitions are in memory at a time.  The RMSE columns are then means
+                over rotations, followed by their standard deviations ('RMSE Train std', ...) and the RMSE
+                of each rotation ('RMSE Train 0', ...).
+    '''
     n_epochs = n_epochs_choices
     n_hidden_units_per_layer = n_hidden_units_per_layer_choices
     activation_function_options = activation_function_choices
     
-    Xtrain, Ttrain, Xvalidate, Tvalidate, Xtest, Ttest = partition(X, T, n_folds)
-    
-    learn_rate = .01
-    
-    for epoch in n_epochs : 
-        for layer in n_hidden_units_per_layer :
-            for activation in activation_function_options : 
-                
-                
-                adam_sample = NeuralNetwork(X.shape[1], layer, 1, activation_function = activation)
-                adam_sample.train(Xtrain, Ttrain, epoch, learn_rate, method = "adam")
-                
-                train_pred = adam_sample.use(Xtrain)
-                validate_pred = adam_sample.use(Xvalidate)
-                test_pred = adam_sample.use(Xtest)
-                
-                train_error = rmse(Ttrain, train_pred)
-                validate_error = rmse(Tvalidate, validate_pred)
-                test_error = rmse(Ttest, test_pred)
-                
-                output.append([epoch, layer, learn_rate, activation, train_error, validate_error, test_error])
-       
-    return pd.DataFrame(output, columns=['epochs', 'layer', 'learning_rate', 'activation_function', 'RMSE Train', 'RMSE Val', 'RMSE Test'])
+    if cross_validate:
+        partitions = (X, T, partition_indices(X.shape[0], n_folds))
+        foldis = list(range(n_folds))
+    else:
+        partitions = partition(X, T, n_folds)
+        foldis = [None]
+
+    learn_rate = learning_rate
+    schedules = [None] if schedule_choices is None else schedule_choices
+
+    if epoch_ladder:
+        configs = [(list(n_epochs), layer, activation, schedule) for layer in n_hidden_units_per_layer
+                                                                 for activation in activation_function_options
+                                                                 for schedule in schedules]
+    else:
+        configs = [([epoch], layer, activation, schedule) for epoch in n_epochs
+                                                          for layer in n_hidden_units_per_layer
+                                                          for activation in activation_function_options
+                                                          for schedule in schedules]
+    n_configs = len(configs)
+    # All configurations of one rotation before those of the next, so each rotation's partitions are made once.
+    configs = [config + (foldi,) for foldi in foldis for config in configs]
+    if n_workers is None:
+        seeds = [None] * len(configs)
+    else:
+        seeds = [int(seed) for seed in np.random.randint(0, 2**31 - 1, size=len(configs))]
+    configs = [(epochs, layer, learn_rate, activation, seed, patience, schedule, foldi)
+               for (epochs, layer, activation, schedule, foldi), seed in zip(configs, seeds)]
+
+    if n_workers is None or n_workers == 1:
+        init_run_config(partitions)
+        try:
+            results = [run_config(config) for config in configs]
+        finally:
+            # Do not keep the data alive in this process after run_experiment returns.
+            run_config.partitions = None
+            run_config.fold = (None, None)
+    else:
+        # fork lets workers use classes defined in a notebook, which other start methods cannot import.
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                                                    initializer=init_run_config, initargs=(partitions,)) as pool:
+            results = list(pool.map(run_config, configs))
+
+    columns = ['epochs', 'layer', 'learning_rate', 'activation_function']
+    if schedule_choices is not None:
+        columns.append('schedule')
+    error_columns = ['RMSE Train', 'RMSE Val', 'RMSE Test']
+
+    if cross_validate:
+        # Combine the results of the rotations of each configuration, which are n_configs apart.
+        fold_results = [results[configi::n_configs] for configi in range(n_configs)]
+        results = []
+        for rotations in fold_results:
+            rows = []
+            for epochi in range(len(rotations[0])):
+                errors = np.array([rotation_rows[epochi][-3:] for rotation_rows in rotations])
+                rows.append(rotations[0][epochi][:-3] + list(errors.mean(axis=0)) + list(errors.std(axis=0)) +
+                            list(errors.T.flat))
+            results.append(rows)
+        error_columns = (error_columns + [column + ' std' for column in error_columns] +
+                         [f'{column} {foldi}' for column in error_columns for foldi in foldis])
+
+    # Order rows by epochs, then layer, then activation function, then schedule, as the nested loops would.
+    output = [rows[epochi] for epochi in range(len(results[0])) for rows in results]
+
+    return pd.DataFrame(output, columns=columns + error_columns)
 
 
 # In[24]:
@@ -1082,6 +2201,693 @@ result_df = run_experiment(X, T, n_folds=5,
 result_df
 
 
+# ## float32 Training
+# 
+# `NeuralNetwork` can keep its weights, gradients and layer outputs as `np.float32` by giving `dtype=np.float32`, with `optimizer_dtype=np.float64` to keep Adam's moments in double precision.  The following test checks that this gives nearly the same RMSE on the auto-mpg data as `np.float64`.
+
+# In[25]:
+
+
+def test_float32(rtol=0.02):
+
+    data = A2data.load('auto-mpg.data-original')
+    X = data[:, 1:]
+    T = data[:, 0:1]
+
+    np.random.seed(42)
+    Xtrain, Ttrain, Xvalidate, Tvalidate, Xtest, Ttest = partition(X, T, 5)
+
+    rmses = {}
+    for dtype, optimizer_dtype in [(np.float64, None), (np.float32, np.float64), (np.float32, None)]:
+        np.random.seed(42)
+        nnet = NeuralNetwork(X.shape[1], [10, 10], 1, 'tanh', dtype=dtype, optimizer_dtype=optimizer_dtype)
+        nnet.train(Xtrain, Ttrain, 2000, 0.01, method='adam')
+        rmses[dtype.__name__, optimizer_dtype and optimizer_dtype.__name__] = [rmse(Ttrain, nnet.use(Xtrain)),
+                                                                              rmse(Ttest, nnet.use(Xtest))]
+
+    for (dtype, optimizer_dtype), (train_rmse, test_rmse) in rmses.items():
+        print(f'{dtype} weights, {optimizer_dtype or dtype} optimizer: RMSE Train {train_rmse:.4f} RMSE Test {test_rmse:.4f}')
+        if not np.allclose([train_rmse, test_rmse], rmses['float64', None], rtol=rtol):
+            raise Exception(f'RMSE with {dtype} weights is not within {rtol} of RMSE with float64 weights')
+
+
+# In[26]:
+
+
+test_float32()
+
+
+# ## Ensembles of Networks
+# 
+# Small networks spend most of their training time in Python rather than in their small matrix multiplications.  `NeuralNetworkEnsemble` trains several networks with the same architecture together, holding their weights as rows of one matrix so each layer of all of them is calculated with one batched `np.matmul`.  Each network is still available as its own `NeuralNetwork` in `members`, whose weights are views into the ensemble's.
+
+# In[27]:
+
+
+import time
+
+
+class NeuralNetworkEnsemble(NeuralNetwork):
+
+    def __init__(self, n_inputs, n_hiddens_per_layer, n_outputs, n_networks, activation_function='tanh',
+                 seeds=None, dtype=np.float64, optimizer_dtype=None):
+        '''n_networks: number of networks in the ensemble
+seeds: if given, one seed for np.random.seed before initializing the weights of each network
+Other arguments are as for NeuralNetwork.'''
+
+        self.members = []
+        for k in range(n_networks):
+            if seeds is not None:
+                np.random.seed(seeds[k])
+            self.members.append(NeuralNetwork(n_inputs, n_hiddens_per_layer, n_outputs, activation_function,
+                                              dtype=dtype, optimizer_dtype=optimizer_dtype))
+        first = self.members[0]
+
+        self.n_networks = n_networks
+        self.n_inputs = n_inputs
+        self.n_outputs = n_outputs
+        self.n_hiddens_per_layer = first.n_hiddens_per_layer
+        self.activation_function = activation_function
+        self.setup_activations(activation_function)
+        self.dtype = first.dtype
+        self.optimizer_dtype = optimizer_dtype
+        self.shapes = first.shapes
+
+        # self.all_weights: n_networks x n_weights matrix, one row per network
+        # self.Ws: list of n_networks x n_in + 1 x n_units weight arrays by layer
+        self.all_weights = np.vstack([member.all_weights for member in self.members])
+        self.Ws = self.make_views(self.all_weights, self.shapes)
+        self.all_gradients = np.zeros_like(self.all_weights)
+        self.dE_dWs = self.make_views(self.all_gradients, self.shapes)
+        for member, member_weights in zip(self.members, self.all_weights):
+            member.all_weights = member_weights
+            member.Ws = member.make_views(member_weights, self.shapes)
+
+        self.setup_state()
+
+
+    def __repr__(self):
+        return f'NeuralNetworkEnsemble({self.n_inputs}, {self.n_hiddens_per_layer}, {self.n_outputs}, {self.n_networks})'
+
+
+    def optimize(self, method, n_epochs, learning_rate, fargs=[], batches_f=None, epoch_callback_f=None,
+                 workspace=False, schedule=None, start_epoch=0):
+        '''learning_rate can be one value for all networks or a sequence of one value for each.
+workspace is not supported and is ignored.  The ensemble's error_trace is the RMSE of the mean of the networks'
+mean squared errors.  Each member's error_trace is its own RMSE, for the last batch of each epoch.'''
+
+        if method == 'lbfgs':
+            raise Exception("NeuralNetworkEnsemble does not support 'lbfgs', whose line search would couple the networks")
+        if np.ndim(learning_rate) > 0:
+            learning_rate = np.reshape(learning_rate, (-1, 1)).astype(self.dtype)
+
+        member_error_traces = []
+        def member_epoch_callback_f(epoch, error):
+            member_error_traces.append(np.sqrt(self.member_errors) * self.Tstds[0])
+            return epoch_callback_f(epoch, error) if epoch_callback_f else False
+
+        super().optimize(method, n_epochs, learning_rate, fargs=fargs, batches_f=batches_f,
+                         epoch_callback_f=member_epoch_callback_f, schedule=schedule, start_epoch=start_epoch)
+
+        for member, error_trace in zip(self.members, np.array(member_error_traces).reshape((-1, self.n_networks)).T):
+            member.error_trace += list(error_trace)
+            member.total_epochs += len(error_trace)
+            member.trained = True
+        self.share_standardization()
+
+
+    def update_standardization(self, X, T):
+        '''As for NeuralNetwork, and the members are given the new standardization parameters, so their
+predictions do not change either.'''
+        super().update_standardization(X, T)
+        self.share_standardization()
+
+
+    def share_standardization(self):
+        '''Give each member the ensemble's standardization parameters, for use with the member's weights.'''
+        for member in self.members:
+            member.Xmeans, member.Xstds, member.Tmeans, member.Tstds = self.Xmeans, self.Xstds, self.Tmeans, self.Tstds
+
+
+    def forward_pass(self, X):
+        '''X assumed already standardized, n_samples x n_inputs.  Each element of the returned list, after X, is
+n_networks x n_samples x n_units.'''
+        self.Ys = [X]
+        self.Ss = []
+        self.auxs = []
+        for W, (f, df, derivative_from_input, saves_aux) in zip(self.Ws[:-1], self.activations):
+            S = self.Ys[-1] @ W[:, 1:, :] + W[:, 0:1, :]
+            self.Ss.append(S if derivative_from_input else None)
+            self.auxs.append(np.empty_like(S) if saves_aux else None)
+            self.Ys.append(f(S, aux=self.auxs[-1]) if saves_aux else f(S))
+        last_W = self.Ws[-1]
+        self.Ys.append(self.Ys[-1] @ last_W[:, 1:, :] + last_W[:, 0:1, :])
+        return self.Ys
+
+
+    def error_and_gradient(self, X, T):
+        Ys = self.forward_pass(X)
+        error = T - Ys[-1]
+        # Each network's gradient depends only on its own error, so the mean over networks can be minimized.
+        self.member_errors = np.mean(error ** 2, axis=(1, 2), dtype=np.float64)
+        return np.mean(self.member_errors), self.backpropagate(error)
+
+
+    def backpropagate(self, error):
+        '''error is T - self.Ys[-1], n_networks x n_samples x n_outputs.'''
+        n_samples, n_outputs = error.shape[1:]
+        delta = - error / (n_samples * n_outputs)
+        n_layers = len(self.n_hiddens_per_layer) + 1
+        for layeri in range(n_layers - 1, -1, -1):
+            self.dE_dWs[layeri][:, 1:, :] = np.swapaxes(self.Ys[layeri], -1, -2) @ delta
+            self.dE_dWs[layeri][:, 0, :] = np.sum(delta, 1, dtype=np.float64)
+            if layeri == 0:
+                break
+            f, df, derivative_from_input, saves_aux = self.activations[layeri - 1]
+            S_or_Y = self.Ss[layeri - 1] if derivative_from_input else self.Ys[layeri]
+            dY = df(S_or_Y, aux=self.auxs[layeri - 1]) if saves_aux else df(S_or_Y)
+            delta = delta @ np.swapaxes(self.Ws[layeri][:, 1:, :], 1, 2) * dY
+        return self.all_gradients
+
+
+    def forward_pass_in_place(self, X):
+        raise Exception('NeuralNetworkEnsemble does not support workspaces')
+
+
+    def freeze(self):
+        '''Freeze each member.  self.frozen is the list of their InferencePlans.'''
+        for member in self.members:
+            member.freeze()
+        self.frozen = [member.frozen for member in self.members]
+        return self
+
+
+    def predict(self, X):
+        '''Like use, n_networks x n_samples x n_outputs, from each member's predict.'''
+        if self.frozen is None:
+            raise Exception('NeuralNetworkEnsemble must be frozen with freeze() before predict is called')
+        return np.stack([member.predict(X) for member in self.members])
+
+
+    def save(self, filename):
+        raise Exception('NeuralNetworkEnsemble cannot be saved as one network.  Save each of its members instead, '
+                        'as in ensemble.members[k].save(filename)')
+
+
+# In[28]:
+
+
+def test_ensemble(n_networks=20):
+    '''Compare time to train n_networks separately and as an ensemble.'''
+    
+    X = np.arange(100).reshape((-1, 1))
+    T = np.sin(X * 0.04)
+    seeds = range(n_networks)
+
+    start = time.time()
+    separate_errors = []
+    for seed in seeds:
+        np.random.seed(seed)
+        nnet = NeuralNetwork(1, [10], 1)
+        nnet.train(X, T, 1000, 0.01, method='adam')
+        separate_errors.append(nnet.error_trace[-1])
+    separate_time = time.time() - start
+
+    start = time.time()
+    ensemble = NeuralNetworkEnsemble(1, [10], 1, n_networks, seeds=seeds)
+    ensemble.train(X, T, 1000, 0.01, method='adam')
+    ensemble_errors = [member.error_trace[-1] for member in ensemble.members]
+    ensemble_time = time.time() - start
+
+    print(f'{n_networks} networks trained separately in {separate_time:.2f} seconds, as an ensemble in {ensemble_time:.2f} seconds')
+    print(f'Largest difference in final RMSE is {np.max(np.abs(np.array(separate_errors) - ensemble_errors)):.2e}')
+    print(f'Largest difference between predict and use is {np.max(np.abs(ensemble.freeze().predict(X) - ensemble.use(X))):.2e}')
+
+
+# In[29]:
+
+
+test_ensemble()
+
+
+# ## Micro-batching Requests
+# 
+# When a trained network serves many concurrent requests of one or a few samples each, most of the time for each call to `use` goes to Python overhead rather than to calculation.  `MicroBatcher` is an `asyncio` front end that collects requests until it has `max_batch_size` samples or the first request has waited `max_wait_us` microseconds, makes one call to `use` (or another prediction function, such as `predict` of a frozen network) for all of them, and returns each request's rows of the result.
+
+# In[30]:
+
+
+import asyncio
+
+
+class MicroBatcher():
+
+    def __init__(self, nnet, max_batch_size=64, max_wait_us=500, predict_f=None):
+        '''nnet: trained NeuralNetwork
+max_batch_size: most samples to combine into one batch.  A single larger request is still run, as its own batch.
+max_wait_us: most microseconds to wait for more requests after the first one of a batch arrives
+predict_f: function called with each batch of samples, which defaults to nnet.use'''
+        self.nnet = nnet
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_us * 1e-6
+        self.predict_f = predict_f or nnet.use
+        self.queue = None
+        self.task = None
+        # Requests taken from the queue by run and not yet answered, so stop can fail them.
+        self.batch = []
+        self.next_request = None
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_samples = 0
+        self.batch_sizes = {}  # number of batches for each number of samples in a batch
+        self.max_queue_depth = 0
+
+    def metrics(self):
+        '''Current queue depth and counts of requests, batches and samples since the last reset_metrics.'''
+        return {'queue_depth': self.queue.qsize() if self.queue else 0,
+                'max_queue_depth': self.max_queue_depth,
+                'requests': self.n_requests,
+                'batches': self.n_batches,
+                'samples': self.n_samples,
+                'mean_batch_size': self.n_samples / max(1, self.n_batches),
+                'batch_sizes': dict(sorted(self.batch_sizes.items()))}
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self
+
+    async def stop(self):
+        '''Stop running batches.  Requests not yet answered, including those of a batch being run, raise an
+Exception in their callers of predict.'''
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        pending = self.batch + ([self.next_request] if self.next_request else [])
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for X, future in pending:
+            if not future.done():
+                future.set_exception(Exception('MicroBatcher was stopped before the request was run'))
+        self.batch = []
+        self.next_request = None
+        self.queue = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    async def predict(self, X):
+        '''Return prediction for X, an n_samples x n_inputs matrix, from the next batch run.'''
+        if self.queue is None:
+            raise Exception('MicroBatcher must be started, with start() or async with, before predict is called')
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((X, future))
+        self.n_requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.batch = requests = [self.next_request or await self.queue.get()]
+            self.next_request = None
+            n_samples = requests[0][0].shape[0]
+            deadline = loop.time() + self.max_wait
+            while n_samples < self.max_batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self.queue.get_nowait()
+                if n_samples + request[0].shape[0] > self.max_batch_size:
+                    self.next_request = request  # starts the next batch
+                    break
+                requests.append(request)
+                n_samples += request[0].shape[0]
+
+            # Run the batch in another thread so requests can keep arriving.
+            try:
+                Y = await loop.run_in_executor(None, self.predict_f, np.vstack([X for X, future in requests]))
+            except Exception as ex:
+                for X, future in requests:
+                    if not future.done():
+                        future.set_exception(ex)
+                continue
+
+            start = 0
+            for X, future in requests:
+                if not future.done():
+                    future.set_result(Y[start:start + X.shape[0]])
+                start += X.shape[0]
+            self.batch = []
+
+            self.n_batches += 1
+            self.n_samples += n_samples
+            self.batch_sizes[n_samples] = self.batch_sizes.get(n_samples, 0) + 1
+
+    async def run_clients(self, X, n_clients, n_requests_per_client):
+        '''Benchmark client.  Start n_clients that each send n_requests_per_client single-sample requests, one
+after another, with samples from X.  Return list of latencies in seconds.'''
+        loop = asyncio.get_running_loop()
+        latencies = []
+
+        async def client(clienti):
+            for requesti in range(n_requests_per_client):
+                row = (clienti * n_requests_per_client + requesti) % X.shape[0]
+                start = loop.time()
+                await self.predict(X[row:row + 1, :])
+                latencies.append(loop.time() - start)
+
+        await asyncio.gather(*[client(clienti) for clienti in range(n_clients)])
+        return latencies
+
+
+def benchmark_micro_batcher(nnet, X, max_batch_size_choices=[1, 8, 64], max_wait_us_choices=[0, 200, 1000],
+                            n_clients=64, n_requests_per_client=50, predict_f=None):
+    '''Measure throughput and latency of single-sample requests through MicroBatcher for each combination of
+max_batch_size and max_wait_us.  Runs its own event loop in another thread, so it can also be called
+from a notebook, whose event loop is already running.  Returns a pandas.DataFrame.'''
+
+    async def run_all():
+        output = []
+        for max_batch_size in max_batch_size_choices:
+            for max_wait_us in max_wait_us_choices:
+                async with MicroBatcher(nnet, max_batch_size, max_wait_us, predict_f) as batcher:
+                    start = time.perf_counter()
+                    latencies = await batcher.run_clients(X, n_clients, n_requests_per_client)
+                    elapsed = time.perf_counter() - start
+                    metrics = batcher.metrics()
+                output.append([max_batch_size, max_wait_us, len(latencies) / elapsed,
+                               np.percentile(latencies, 50) * 1e3, np.percentile(latencies, 99) * 1e3,
+                               metrics['mean_batch_size'], metrics['max_queue_depth']])
+        return output
+
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        output = pool.submit(asyncio.run, run_all()).result()
+    return pd.DataFrame(output, columns=['max batch size', 'max wait us', 'requests/sec', 'p50 ms', 'p99 ms',
+                                         'mean batch size', 'max queue depth'])
+
+
+# In[31]:
+
+
+np.random.seed(42)
+nnet = NeuralNetwork(X.shape[1], [10], 1).train(X, T, 100, 0.01, method='adam')
+benchmark_micro_batcher(nnet, X)
+
+
+# ## Frozen Networks
+# 
+# `NeuralNetwork.freeze` builds an `InferencePlan`, which holds only what is needed to calculate outputs: contiguous weight and bias arrays for each layer, with the standardization folded in, and the activation functions already looked up.  `InferencePlan.export` writes it as a Python module that needs only NumPy, for scoring jobs that should not import the training code.
+
+# In[32]:
+
+
+import base64
+import threading
+
+
+class InferencePlan():
+
+    # NumPy source of activation functions for export, each modifying and returning S.
+    activation_sources = {
+        'tanh': 'np.tanh(S, out=S)',
+        'relu': 'np.maximum(S, 0, out=S)',
+        'swish': 'np.multiply(S, 0.5 * (1 + np.tanh(0.5 * S)), out=S)',
+        'gelu': 'np.multiply(S, 0.5 * (1 + np.tanh(np.sqrt(2 / np.pi) * (S + 0.044715 * S ** 3))), out=S)'}
+
+    def __init__(self, layers, activation_names, activation_fs, dtype):
+        '''layers: list of (W, b) for each layer, in which inputs and outputs are not standardized
+activation_names: names of the activation functions of the hidden layers, for export
+activation_fs: activation functions of the hidden layers, called as f(S, out=Y)'''
+        self.layers = [(np.ascontiguousarray(W, dtype=dtype), np.ascontiguousarray(b, dtype=dtype))
+                       for W, b in layers]
+        self.activation_names = activation_names
+        self.activation_fs = activation_fs
+        self.dtype = dtype
+        # Each thread that calls predict gets its own arrays for weighted sums and outputs of hidden layers.
+        self.scratch = threading.local()
+
+    def predict(self, X):
+        '''Only the returned array is new.  Hidden layers are calculated in arrays kept for each thread
+and reused by later calls.'''
+        X = np.asarray(X, dtype=self.dtype)
+        if len(self.layers) == 1:
+            W, b = self.layers[0]
+            Y = X @ W
+            Y += b
+            return Y
+
+        n_samples = X.shape[0]
+        scratch = self.scratch
+        if getattr(scratch, 'n_samples', 0) < n_samples:
+            scratch.n_samples = n_samples
+            scratch.arrays = [(np.empty((n_samples, W.shape[1]), dtype=self.dtype),
+                               np.empty((n_samples, W.shape[1]), dtype=self.dtype)) for W, b in self.layers[:-1]]
+        Y = X
+        for (W, b), f, (S, Ynext) in zip(self.layers[:-1], self.activation_fs, scratch.arrays):
+            S = S[:n_samples]
+            np.matmul(Y, W, out=S)
+            S += b
+            Y = f(S, out=Ynext[:n_samples])
+        W, b = self.layers[-1]
+        Y = Y @ W
+        Y += b
+        return Y
+
+    def export(self, filename):
+        '''Write a Python module to filename that defines predict(X) for this plan, using only NumPy.'''
+        for name in self.activation_names:
+            if name not in self.activation_sources:
+                raise Exception(f'No NumPy source to export for activation function {name!r}')
+
+        def array_source(A):
+            data = base64.b64encode(A.tobytes()).decode()
+            return f"np.frombuffer(base64.b64decode('{data}'), dtype='{A.dtype.str}').reshape({A.shape})"
+
+        lines = ['# Generated by InferencePlan.export.  Inputs and outputs are not standardized.',
+                 '',
+                 'import base64',
+                 'import numpy as np',
+                 '',
+                 f"dtype = np.dtype('{np.dtype(self.dtype).str}')",
+                 '',
+                 'layers = [']
+        for W, b in self.layers:
+            lines.append(f'    ({array_source(W)},')
+            lines.append(f'     {array_source(b)}),')
+        lines.append(']')
+        lines.append('')
+        for name in sorted(set(self.activation_names)):
+            lines += ['', f'def {name}(S):', f'    return {self.activation_sources[name]}', '']
+        lines.append(f"activations = [{', '.join(self.activation_names)}]")
+        lines += ['',
+                  '',
+                  'def predict(X):',
+                  '    Y = np.asarray(X, dtype=dtype)',
+                  '    for (W, b), f in zip(layers[:-1], activations):',
+                  '        Y = f(Y @ W + b)',
+                  '    W, b = layers[-1]',
+                  '    return Y @ W + b',
+                  '']
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines))
+
+
+# ## Profiling Training
+# 
+# To see where the time of training goes, assign a `Profiler` to a network's `profiler` before calling `train`.  Each epoch then records the wall-clock time of the forward pass and back-propagation of each layer, the optimizer step, the epoch callback (such as validation) and printing, and, if `trace_allocations` is true, the peak number of bytes `tracemalloc` saw allocated during each phase.  Use the profiler in a `with` statement, or call its `close`, to stop `tracemalloc` again.  With no profiler, each phase costs only a test for `None`.  `to_json` writes the record of every epoch, which can be compared across runs.
+
+# In[33]:
+
+
+import tracemalloc
+
+
+class Profiler():
+
+    def __init__(self, trace_allocations=False, callbacks=None):
+        '''trace_allocations: also record peak bytes allocated in each phase, which slows every allocation
+callbacks: functions called as f(phase, seconds, n_bytes) at the end of each phase'''
+        self.trace_allocations = trace_allocations
+        self.callbacks = list(callbacks or [])
+        # Only stop tracemalloc in close if this profiler started it.
+        self.started_tracing = trace_allocations and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        self.reset()
+
+    def close(self):
+        '''Stop recording allocations, and stop tracemalloc if this profiler started it.'''
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        self.trace_allocations = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def reset(self):
+        self.phases = {}   # [calls, seconds, peak bytes] of each phase in the current epoch
+        self.epochs = []   # {'epoch', 'error', 'phases'} of each finished epoch
+        self.running = []  # [traced bytes at start, peak bytes of finished inner phases] of each running phase
+
+    def start(self):
+        '''Returns a token to give to stop at the end of the phase.'''
+        if self.trace_allocations:
+            self.running.append([tracemalloc.get_traced_memory()[0], 0])
+            tracemalloc.reset_peak()
+        return time.perf_counter()
+
+    def stop(self, phase, token):
+        seconds = time.perf_counter() - token
+        n_bytes = 0
+        if self.trace_allocations:
+            # reset_peak by an inner phase loses the peak before it, so inner phases pass their peaks out.
+            start_bytes, inner_peak = self.running.pop()
+            peak = max(tracemalloc.get_traced_memory()[1], inner_peak)
+            n_bytes = peak - start_bytes
+            if self.running:
+                self.running[-1][1] = max(self.running[-1][1], peak)
+        totals = self.phases.get(phase)
+        if totals is None:
+            totals = self.phases[phase] = [0, 0.0, 0]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], n_bytes)
+        for callback in self.callbacks:
+            callback(phase, seconds, n_bytes)
+
+    def end_epoch(self, epoch, error):
+        self.epochs.append({'epoch': epoch, 'error': float(error), 'phases': self.phases})
+        self.phases = {}
+
+    def totals(self):
+        '''Dictionary of [calls, seconds, peak bytes] of each phase over all epochs.'''
+        totals = {}
+        for phases in [epoch['phases'] for epoch in self.epochs] + [self.phases]:
+            for phase, (calls, seconds, n_bytes) in phases.items():
+                total = totals.setdefault(phase, [0, 0.0, 0])
+                total[0] += calls
+                total[1] += seconds
+                total[2] = max(total[2], n_bytes)
+        return totals
+
+    def summary(self):
+        '''DataFrame of totals, slowest phase first.  Times of phases containing other phases include them.'''
+        df = pd.DataFrame([[phase] + total for phase, total in self.totals().items()],
+                          columns=('phase', 'calls', 'seconds', 'peak bytes'))
+        df['seconds per call'] = df['seconds'] / df['calls']
+        return df.sort_values('seconds', ascending=False, ignore_index=True)
+
+    def to_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'totals': self.totals(), 'epochs': self.epochs}, f, indent=1, sort_keys=True)
+
+
+# In[34]:
+
+
+def test_profiler():
+    X = np.arange(1000).reshape((-1, 1)) * 0.01
+    T = np.sin(X)
+    np.random.seed(42)
+    nnet = NeuralNetwork(1, [50, 50], 1, 'swish')
+    with Profiler(trace_allocations=True) as profiler:
+        nnet.profiler = profiler
+        nnet.train(X, T, 100, 0.01, method='adam', batch_size=100)
+    print(profiler.summary())
+
+
+test_profiler()
+
+
+# ## Out-of-core Training
+# 
+# `train_out_of_core` trains from arrays that do not fit in memory, such as `.npy` files opened with `np.load(filename, mmap_mode='r')` or `A2data.load(filename, mmap_mode='r')`.  Standardization parameters come from one pass over the data with `RunningStats`, and each batch is standardized only when it is used.
+
+# In[35]:
+
+
+def test_out_of_core(n_samples=200000, directory='.'):
+    '''Train from a memory-mapped .npy file and compare its streamed standardization parameters to np.mean
+and np.std of the data in memory.'''
+
+    filename = os.path.join(directory, 'test_out_of_core.npy')
+    rng = np.random.default_rng(42)
+    data = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64, shape=(n_samples, 4))
+    data[:, 1:] = rng.normal(1000, 5, size=(n_samples, 3))
+    data[:, 0] = np.tanh((data[:, 1:] - 1000) / 5).sum(axis=1)
+    data.flush()
+    del data
+
+    data = np.load(filename, mmap_mode='r')
+    np.random.seed(42)
+    nnet = NeuralNetwork(3, [10], 1).train_out_of_core(data[:, 1:], data[:, 0:1], 5, 0.01, method='adam',
+                                                       batch_size=1000)
+    in_memory = np.array(data)
+    print('Largest difference from np.mean:', np.max(np.abs(nnet.Xmeans - in_memory[:, 1:].mean(axis=0))))
+    print('Largest difference from np.std: ', np.max(np.abs(nnet.Xstds - in_memory[:, 1:].std(axis=0))))
+    print('RMSE', rmse(in_memory[:, 0:1], nnet.use(in_memory[:, 1:])))
+    del data, in_memory
+    os.remove(filename)
+
+
+test_out_of_core()
+
+
+# ## Continual Training
+# 
+# To keep training a network as new data arrives, call `train` with `update_standardization=True`.  The standardization parameters are then updated to include the new samples, using the counts, means and sums of squares kept in `RunningStats`, and the weights of the first and last layers are changed so the network's predictions are the same as before the update.  Training then continues from there, without another pass over the earlier samples.
+
+# In[36]:
+
+
+def test_update_standardization():
+    '''Shift the mean and scale of the data between calls to train, and check that updating the standardization
+parameters does not change the network's predictions.'''
+
+    rng = np.random.default_rng(42)
+    X = rng.normal(0, 1, size=(500, 3))
+    T = np.sin(X).sum(axis=1, keepdims=True)
+    np.random.seed(42)
+    nnet = NeuralNetwork(3, [10, 5], 1, 'tanh').train(X, T, 100, 0.01, method='adam')
+
+    Xnew = rng.normal(2, 3, size=(500, 3))
+    Tnew = np.sin(Xnew).sum(axis=1, keepdims=True) * 2 + 10
+    before = nnet.use(Xnew)
+    nnet.update_standardization(Xnew, Tnew)
+    after = nnet.use(Xnew)
+    print('Largest change in predictions from updating standardization:', np.max(np.abs(after - before)))
+
+    Xall = np.vstack((X, Xnew))
+    print('Largest difference from np.mean and np.std of all samples:',
+          max(np.max(np.abs(nnet.Xmeans - Xall.mean(axis=0))), np.max(np.abs(nnet.Xstds - Xall.std(axis=0)))))
+
+    nnet.train(Xnew, Tnew, 100, 0.01, method='adam')
+    print('RMSE on new samples after continuing training:', rmse(Tnew, nnet.use(Xnew)))
+
+
+test_update_standardization()
+
+
 # In[ ]:
 
 